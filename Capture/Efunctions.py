@@ -0,0 +1,49 @@
+'''
+Ephemeris functions shared by the capture scripts, astro-info and PolarTransform.
+
+The ephemerides file is only opened the first time it is needed and then kept open (skyfield reads the kernel through jplephem, which memory-maps it), the timescale is only loaded once, and the position of the device on the earth is cached for each (lat, long, elv). So scripts and functions can call these as often as they like, instead of each one loading de421.bsp (or worse, loading it for every star in a loop).
+
+Usage (from another directory add the Capture directory to the path first):
+    from Efunctions import ephemeris, timescale, observer
+    eph = ephemeris()
+    ts = timescale()
+    Epos = observer(lat,long,elv)
+
+Author: George Hume
+2022
+'''
+### IMPORTS ###
+from functools import lru_cache
+from skyfield.api import N,E, wgs84, load
+
+##############################################################################################################
+
+@lru_cache(maxsize=None)
+def ephemeris(fname='de421.bsp'):
+    ### loads the ephemerides file the first time it is called, afterwards returns the same one
+    return load(fname)
+
+##############################################################################################################
+
+@lru_cache(maxsize=None)
+def timescale():
+    ### loads the timescale the first time it is called, afterwards returns the same one
+    return load.timescale()
+
+##############################################################################################################
+
+@lru_cache(maxsize=None)
+def topos(lat,long,elv):
+    ### position of the device on the earth (e.g., for almanac functions), cached for each location
+    ## lat and long are in decimal degrees, elv is the elevation in metres
+    return wgs84.latlon(lat * N, long * E, elevation_m=elv)
+
+##############################################################################################################
+
+@lru_cache(maxsize=None)
+def observer(lat,long,elv,fname='de421.bsp'):
+    ### position of the device relative to the solar system barycentre (Epos), used to observe the sun, moon and stars, cached for each location
+    ## lat and long are in decimal degrees, elv is the elevation in metres, fname is the ephemerides file
+    return ephemeris(fname)['earth'] + topos(lat,long,elv)
+
+##############################################################################################################
@@ -34,9 +34,9 @@ Author: George Hume
 '''
 
 ## IMPORTS ##
-from skyfield.api import N,E, wgs84, load
 import time
 from Cfunctions import *
+from Efunctions import ephemeris, timescale, observer
 import gc
 import datetime as dt
 
@@ -50,12 +50,12 @@ devname = prams["device_name"]
 ifmt = prams["image_format"]
 
 ## Set-up ephemerides ##
-#loads in ephemerides and time scale
-eph = load('de421.bsp')
-ts = load.timescale()
+#loads in ephemerides and time scale (only loaded once, shared with everything else in the process)
+eph = ephemeris()
+ts = timescale()
 #sets up sun and moon plus position on earth
-earth, sun = eph['earth'], eph['sun']
-Epos = earth + wgs84.latlon(prams["latitude"] * N, prams["longitude"] * E, elevation_m=prams["elevation"])
+sun = eph['sun']
+Epos = observer(prams["latitude"],prams["longitude"],prams["elevation"])
 
 ## Set-up for capturing ##
 active = False #boolean to check if cam should start exposing - starts on False so can do start up
@@ -68,6 +68,7 @@ templates = ['dome-templates/hflr-template1.jpg', 'dome-templates/hflr-template2
 l1 = [[104,204],[75,175]] #inital xy coordinate limits for template 1
 l2 = [[505,506],[6,106]] #inital xy coordinate limits for template 2
 maxL = [[[25,325],[25,225]],[[450,735],[0,200]]] #max coordinate limits for template 1 and 2
+dome = DomeDetector(templates,l1,l2,maxL,mode="ncc") #templates loaded once, decides from how well they match (confidences in dome.confidence)
 
 
 ### OPERATIONAL LOOP ###
@@ -117,18 +118,16 @@ while True:
             print(f"Loop {i}")
 
             # low resolution glance for dome detection #
-            glance_path = f"{path}/.glance_{tnowfn}.{ifmt}"
-
             print("glanced @ ", dt.datetime.now().strftime("%H:%M:%S")) ##
 
-            temp_exptime = capture(glance_path,exptime,res=[825,640]) #temp exp time, will be made offical if dome is open
+            temp_exptime, gimg = take_glance(exptime,ifmt) #temp exp time, will be made offical if dome is open (glance is only kept in memory)
 
             print("finshed glancing @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with exptime of {temp_exptime/1e6}") ##
 
 
             # check the status of the dome using glance and NEW dome detection function #
-            domestatus,l1,l2 = dome_detect2(glance_path, templates, l1, l2, maxL, domestatus)
-            print("checked if dome is open @ ", dt.datetime.now().strftime("%H:%M:%S")) ##
+            domestatus = dome.detect(gimg, domestatus)
+            print("checked if dome is open @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with confidences {dome.confidence}") ##
 
 
         # OPEN DOME MODE #
@@ -183,7 +182,7 @@ while True:
 
             # makes placeholder and appends it to image list and file #
             ph_path = f"{path}/PH-{tnowfn}_{devname}.{ifmt}"
-            placeholder(devname, prams["location"], timestr, ph_path, glance_path)
+            placeholder(devname, prams["location"], timestr, ph_path, gimg)
             print("made placeholder @ ", dt.datetime.now().strftime("%H:%M:%S")) ##
             imlist.append(img_path) #appends path to image to list of images
             logger(f"{path}/images.list",f"{img_path}\n") #appends path to image to file of list of images
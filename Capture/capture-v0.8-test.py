@@ -4,14 +4,16 @@ Testing version of v0.8 of the capture script for the skyWATCH camera - depends
 What it does:
 - calculates whether it should open depending on the time of day
 - if in daytime mode:
-    - checks every minute if the sun is less than -6 degrees above horizon (end of civil twilight)
+    - works out once per day when the sun will next be less than -6 degrees above horizon (end of civil twilight) and when it will rise above it again, and sleeps until then
     - if it is then changes to night-time mode, makes a directory to save images to and creates a log for the night where it notes down key info
     - if not it stays in daytime mode
 - if in night-time mode
-    - checks if it is still night-time mode (if not switches to day-time; if so continues).
+    - checks if it is still night-time mode (if not switches to day-time; if so continues), with the sun's altitude taken from a table made at the start of the night
     - detects if the dome is open via taking a low-resolution temporary image
+        - in predictive mode a downsampled copy of the previous image is used instead, and its exposure time is predicted from it, so each image only needs one exposure (a glance is still taken after the dome has been closed or if the sky brightness jumps)
     - if the dome is open:
-        - takes an exposure using subprocess to call raspistill; estimates the exposure time this image using an estimate for the sensor's light sensitivity and a lower resolution temporary image taken at with the exposure time of the previous on sky image (max exposure time for pi HQ camera is set to be 90s).
+        - takes an exposure using a camera session that stays open for the whole night (no raspistill process per frame); estimates the exposure time this image using an estimate for the sensor's light sensitivity and a lower resolution temporary image taken at with the exposure time of the previous on sky image (max exposure time for pi HQ camera is set to be 90s).
+            - exposure times are set by a controller that learns the sensor's response and how fast the sky darkens with the sun's altitude, so fewer images are badly exposed during twilight
             - images are annoted with device name, location, time, and exposure time
             - images are saved as greyscale due to issue with `-awb greyworld` not working in raspistill
         - calculates the time of day (depends on the sun's altitude)
@@ -21,28 +23,30 @@ What it does:
         - device sleeps for 1 min then takes a temporary image each minute to check if it has reopened
         - also automatically creates a placeholder image used in timelapse for when the dome is closed
 
+    - post-processing of each image (sun and moon info, JSON, thumbnail, logging) is done by a worker thread while the camera is taking the next image, so the camera is exposing for nearly all of the night (in predictive mode the dome check on the image is done straight after it is taken, as it only takes a few ms, so a closure is never missed)
     - clears memory after each night capture to reduce the load on the raspberry pi
     - all exposures can be specified to be in JPG or PNG format (via editing the setup file)
     - no longer any set time delays between captures
     - at the end of the night it converts the images into a timelapse mp4
 
+- capture, dome polling, BME280 sensor readings (every 10 mins) and astro-info updates (every 30 mins) are run as concurrent tasks by an asyncio scheduler, instead of nested loops with sleeps
+
 
     * in this testing script a separate timestamped testing log is produced and all the dome detection glances are saved *
 
 
 To-do:
 - make an option to load in your own templates for the dome detect (or it could make ones for you?)
-- make a version for the new pi-cam api
-- include the temperature sensor readings
 
 Author: George Hume
 2022
 '''
 
 ## IMPORTS ##
-from skyfield.api import N,E, wgs84, load
 import time
 from Cfunctions import *
+from Efunctions import ephemeris, timescale, topos as Etopos, observer
+from scheduler import Scheduler
 import gc
 import datetime as dt
 
@@ -56,17 +60,24 @@ devname = prams["device_name"]
 ifmt = prams["image_format"]
 
 ## Set-up ephemerides ##
-#loads in ephemerides and time scale
-eph = load('de421.bsp')
-ts = load.timescale()
+#loads in ephemerides and time scale (only loaded once, shared with everything else in the process)
+eph = ephemeris()
+ts = timescale()
 #sets up sun and moon plus position on earth
-earth, sun = eph['earth'], eph['sun']
-Epos = earth + wgs84.latlon(prams["latitude"] * N, prams["longitude"] * E, elevation_m=prams["elevation"])
+sun = eph['sun']
+topos = Etopos(prams["latitude"],prams["longitude"],prams["elevation"])
+Epos = observer(prams["latitude"],prams["longitude"],prams["elevation"])
+nstart, nend, suntab = None, None, None #start and end of the next night and table of the sun's altitude during it
 
 ## Set-up for capturing ##
 active = False #boolean to check if cam should start exposing - starts on False
 exptime = 500000 #inital exp time - starts at 0.5s (units are micro seconds)
 fullres = [4065, 3040] #defines the full resolution of the images
+cam = CamSession(glance=[825,640],full=fullres) #camera session, opened at the start of each night
+predictive = True #predicts the exposure time from the previous image instead of taking a glance before each image
+predicted = None #predicted exposure time of the next image - None when a glance is needed
+ctrl = ExpController(maxexp=90000000) #learns the sensor response and twilight brightness trend across the night
+region = {} #metering region for estimating exposure times, e.g. {"radius":0.9,"banner":0.03} to exclude the dome edges and annotation banner
 
 ## Set-up for Dome detection ##
 domestatus = True #boolean to check if the dome is open or not - starts on True (closed)
@@ -74,31 +85,96 @@ templates = ['dome-templates/hflr-template1.jpg', 'dome-templates/hflr-template2
 l1 = [[104,204],[75,175]] #inital xy coordinate limits for template 1
 l2 = [[505,506],[6,106]] #inital xy coordinate limits for template 2
 maxL = [[[25,325],[25,225]],[[450,735],[0,200]]] #max coordinate limits for template 1 and 2
+dome = DomeDetector(templates,l1,l2,maxL,mode="ncc") #templates loaded once, decides from how well they match (confidences in dome.confidence)
+
+
+### POST-PROCESSING ###
+def process(img_path,img_name,tnow,exptime,small,nconverge,domeclosed=False):
+    ### post-processing of a captured image, done by the worker thread while the next image is being exposed
+    ## img_path & img_name are the path and name of the image; tnow is the time it was taken; exptime its exposure time (in micro seconds); small its downsampled copy (None to read it in); nconverge is the number of images the exposure time took to converge (if it did on this image)
+    ## domeclosed is True if the dome was found closed in this image (predictive mode, checked by the capture loop before the next exposure)
+
+    timestr = tnow.utc_strftime("%H:%M:%S") #string version of time
+    logger(logname,f"Image {img_name} captured @ {timestr}\n") #logs capture
+    if domeclosed == True:
+        logger(logname,"Dome closed during this image\n")
+    else:
+        logger(logname,"Dome is open\n")
+    if nconverge != None:
+        logger(logname,f"Exposure time converged after {nconverge} images\n")
+
+    imlist.append(img_path) #appends path to image to list of images
+    logger(f"{path}/images.list",f"{img_path}\n") #appends path to image to file of list of images
+
+
+    # thumbnail of the image, also used as the next glance in predictive mode #
+    if small is None:
+        small = cv.resize(cv.imread(img_path,cv.IMREAD_REDUCED_GRAYSCALE_4),[825,640],interpolation=cv.INTER_AREA)
+    glance_path = f"{path}/.glance_{tnow.utc_strftime('%Y%m%d_%H%M%S')}.{ifmt}"
+    cv.imwrite(glance_path,small)
+    thumbs.append(glance_path)
+
+
+    # collects all info #
+    skyprops = SnM(Epos,tnow,eph) #solar, day period, and lunar properties
+    improps = [exptime/1e6, fullres[0], fullres[1]] #saves exptime (in secs), and image width and height
+
+
+    # saves info as a JSON #
+    im_json(img_name,timestr,skyprops,improps,prams,path)
+    logger(logname,f"JSON saved as {img_name[0:-4]}.json\n")
+
+
+    # add blank line to night log
+    logger(logname,"\n")
+
+    testlog(path,["start memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
+    gc.collect() #garbage collection after each image to free up memory
+    testlog(path,["end memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
+    testlog(path,["\n"]) ##
 
 
 ### OPERATIONAL LOOP ###
-while True:
+def cycle():
+    ### one cycle of the capture loop, run by the scheduler
+    ## returns how long to wait (in seconds) before the next cycle
+    global active, path, logname, imlist, datenow, pipe, thumbs, predicted, exptime, domestatus, gimg, nstart, nend, suntab
 
     ## DAY TIME MODE ##
-    while active == False:
+    if active == False:
         # check the time to see if sun is greater than 6 deg below horizon (ie., it is not daytime or civil twilight) #
         tnow = ts.now() #saves time now
 
-        active = sun_check(Epos,tnow,sun)
+        if (nend == None) or (tnow.tt >= nend.tt):
+            #works out when the next night starts and ends, once per day
+            nstart, nend, suntab = night_schedule(eph,topos,tnow)
+            if nstart == None:
+                #no night in the next two days (e.g., summer at high latitudes), so checks again in an hour
+                return 3600
+
+        active = (tnow.tt >= nstart.tt)
         if active == True:
             path,logname,imlist,datenow = startup(tnow,devname,pextra="-test") #different dir path to differentiate directory from real outputs
             logger(logname,f"Capture Script Version: 0.8-test \n\n")
+            cam.start() #sensor stays open until the end of the night
+            pipe = Pipeline(process) #post-processing is done in a worker thread
+            pipe.start()
+            thumbs = [] #glance sized copies of the images, used for the timelapse
+            predicted = None #first image of the night needs a glance
+            ctrl.reset()
             testlog(path,["Night started @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n\n"]) ##
-            break
+            return 0
         else:
-            time.sleep(60) #checks sun's altitude every min
+            #sleeps until the night starts (at most an hour at a time, in case the clock is changed)
+            return min((nstart.tt-tnow.tt)*86400,3600)
 
 
     ## NIGHT TIME MODE ##
-    while active == True:
+    else:
         # check the time to see if sun is greater than 6 deg below horizon (ie., it is not daytime or civil twilight) #
         tnow = ts.now() #saves time now
-        active = sun_check(Epos,tnow,sun)
+        salt = suntab(tnow) #interpolated from the table, also used by the exposure controller
+        active = (tnow.tt < nend.tt)
 
         # convert time into stings #
         timestr = tnow.utc_strftime("%H:%M:%S")
@@ -107,33 +183,40 @@ while True:
 
         if active == False:
             logger(logname,f"Ending captures for the night and creating timelapse.\n")
+            cam.close()
+            pipe.close() #finishes processing the last images
+            for job, e in pipe.errors:
+                logger(logname,f"Processing of {job[1]} failed: {e}\n")
             testlog(path,["Night ended @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
-            timelapse(imlist,f'{path}/timelapse-{datenow}_{devname}.mp4')
+            timelapse(thumbs,f'{path}/timelapse-{datenow}_{devname}.mp4') #thumbnails are already the size of the timelapse
             logger(logname,f"Timelapse movie saved as: timelapse-{datenow}_{devname}.mp4\n")
             testlog(path,["Saved timelapse @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
 
             logger(logname,"\nNIGHT END\n")
-            break
+            return 0
+        elif (predictive == True) & (predicted != None):
+            # previous image was used as the glance by the worker, so no extra exposure is needed #
+            temp_exptime = predicted
+            domeopen = True #dome was found open in the previous image, checked straight after it was taken
+            testlog(path,["used previous image as glance @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with predicted exptime of {temp_exptime/1e6}\n"]) ##
         else:
             # low resolution glance for dome detection #
-            glance_path = f"{path}/.glance_{tnowfn}.{ifmt}"
-
             testlog(path,["glanced @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
 
-            temp_exptime = capture(glance_path,exptime,res=[825,640]) #temp exp time, will be made offical if dome is open
+            temp_exptime, gimg = take_glance(exptime,ifmt,cam=cam,region=region,ctrl=ctrl,salt=salt) #temp exp time, will be made offical if dome is open
+            #the glance is only kept in memory, the same array is used for the metering, dome detection and placeholder
 
             testlog(path,["finshed glancing @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with exptime of {temp_exptime/1e6}\n"]) ##
 
 
             # check the status of the dome using glance and NEW dome detection function #
-            domestatus,l1,l2 = dome_detect2(glance_path, templates, l1, l2, maxL, domestatus)
-            testlog(path,["checked if dome is open @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
+            domestatus = dome.detect(gimg, domestatus)
+            domeopen = (domestatus == False) #copy so the worker can't change it part way through the cycle
+            testlog(path,["checked if dome is open @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with confidences {dome.confidence}\n"]) ##
 
 
         # OPEN DOME MODE #
-        if domestatus == False:
-            # logs dome is open #
-            logger(logname,"Dome is open\n")
+        if domeopen == True:
             exptime = temp_exptime
 
 
@@ -141,7 +224,6 @@ while True:
             tnow = ts.now()
             tnowstr = tnow.utc_strftime("%Y-%m-%d %H:%M:%S") #string version of datetime
             tnowfn = tnow.utc_strftime("%Y%m%d_%H%M%S") #filename version
-            timestr = tnow.utc_strftime("%H:%M:%S") #string version of time
 
             testlog(path,["Dome is open @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
 
@@ -150,48 +232,67 @@ while True:
             img_path = f"{path}/{img_name}"
             testlog(path,["start full res capture @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
             st = time.time() #start time
-            exptime = capture(img_path,exptime,res=fullres,ann=True,prams=prams,t=tnowstr)
+            exptime = capture(img_path,exptime,res=fullres,ann=True,prams=prams,t=tnowstr,cam=cam,glance=False) #exptime was already estimated this cycle (by the glance or predicted from the previous image), so the controller isn't updated twice
             et = time.time() #end time
+            small = cam.last #downsampled copy of the image
+            if predictive == True:
+                predicted, small = predict(exptime,img_path,cam=cam,region=region,ctrl=ctrl,salt=salt) #exptime of next image from this one
+
+                # checks if the dome closed during this image, before the next one is exposed (only takes a few ms) #
+                domestatus = dome.detect(small, domestatus) #thumbnail is already in memory
+                testlog(path,["checked if dome is open from previous image @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with confidences {dome.confidence}\n"]) ##
+                if domestatus == True:
+                    predicted = None #next cycle takes a glance to confirm and makes the placeholder
             testlog(path,["captured full res image @ ", dt.datetime.now().strftime("%H:%M:%S"),f"- with exptime of {exptime/1e6}s this took {et-st} seconds \n"]) ##
-            logger(logname,f"Image {img_name} captured @ {timestr}\n") #logs capture
-
-            imlist.append(img_path) #appends path to image to list of images
-            logger(f"{path}/images.list",f"{img_path}\n") #appends path to image to file of list of images
-
-
-            # collects all info #
-            skyprops = SnM(Epos,tnow,eph) #solar, day period, and lunar properties
-            improps = [exptime/1e6, fullres[0], fullres[1]] #saves exptime (in secs), and image width and height
-
-
-            # saves info as a JSON #
-            im_json(img_name,timestr,skyprops,improps,prams,path)
-            logger(logname,f"JSON saved as {img_name[0:-4]}.json\n")
 
 
-            # add blank line to night log
-            logger(logname,"\n")
-            # no delay between captures
+            # rest is done by the worker while the next image is exposed #
+            pipe.put(img_path,img_name,tnow,exptime,small,ctrl.nconverge,(predictive == True) & (domestatus == True))
+            return 0 # no delay between captures
 
 
         # CLOSED DOME MODE #
         else:
+            pipe.wait() #worker finishes the last image first, so the placeholder and log lines stay in capture order
+
             # logs dome is closed #
             logger(logname,"Dome is closed\n\n")
+            predicted = None #needs a glance once the dome reopens
+            ctrl.reset()
             testlog(path,["dome is closed @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
 
             # makes placeholder and appends it to image list and file #
             ph_path = f"{path}/PH-{tnowfn}_{devname}.{ifmt}"
-            placeholder(devname, prams["location"], timestr, ph_path, glance_path)
+            placeholder(devname, prams["location"], timestr, ph_path, gimg)
             testlog(path,["made placeholder @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
-            imlist.append(img_path) #appends path to image to list of images
-            logger(f"{path}/images.list",f"{img_path}\n") #appends path to image to file of list of images
+            imlist.append(ph_path) #appends path to placeholder to list of images
+            thumbs.append(ph_path)
+            logger(f"{path}/images.list",f"{ph_path}\n") #appends path to placeholder to file of list of images
+
+            testlog(path,["start memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
+            gc.collect() #garbage collection at end of each cycle to free up memory
+            testlog(path,["end memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
+            testlog(path,["\n"]) ##
+
+            return 60 # delay of 60s if dome is closed
+
+
+def sensors():
+    ### reads the BME280 sensor into a CSV for each day
+    try:
+        meto(f"out/meto-{dt.datetime.utcnow().strftime('%Y%m%d')}.csv")
+    except ImportError:
+        return False #no sensor libraries on this device, so stops the task
+
+
+def astro():
+    ### saves the sun and moon info to a JSON (same as astro-info/infoloop.py)
+    astro_json(Epos,ts.now(),eph,prams,"out/astro-info")
 
-            # delay of 60s if dome is closed #
-            time.sleep(60)
-            testlog(path,["finished 60s of sleep @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
 
-        testlog(path,["start memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
-        gc.collect() #garbage collection at end of each cycle to free up memory
-        testlog(path,["end memory clean up @ ", dt.datetime.now().strftime("%H:%M:%S"),"\n"]) ##
-        testlog(path,["\n"]) ##
+### SCHEDULER ###
+sched = Scheduler(logname="out/scheduler.log")
+sched.add("capture",cycle) #capture and dome polling, decides when it runs next
+sched.add("sensors",sensors,period=600) #every 10 mins
+sched.add("astro-info",astro,period=1800) #every 30 mins
+sched.run()
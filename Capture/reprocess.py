@@ -0,0 +1,232 @@
+'''
+Reprocesses archived nights from the capture script: works out again if the dome was open or closed in each image and the sun and moon info for when it was taken, and rewrites the JSON saved next to each image (same as im_json, plus the dome status).
+
+Give it the directories of the nights (out/YYYYMMDD) or the directory they are in (out), and the nights are split between a pool of processes. Each process loads the ephemerides and the dome templates once, goes through a night's images in order (keeping the state of the dome detection between them, as the capture script does) and works out the sun and moon info for all of the night's images in one go. The JSONs are written as each image is done, so if it is stopped part way through the finished ones are kept.
+
+JSONs that are newer than their image and were made with the same templates and settings are skipped, so running it again only does the new or changed images and the ones after them in the night, as the dome detection carries its state from one image to the next (use --force to redo them all). The dome detection limits after each image are saved in its JSON, so the detection carries on from the last skipped image as if it had been redone.
+
+The saved images have the annotation banner drawn across the top, which the glances of the capture script don't (they are downsampled before it is drawn), so the rows of the banner are filled in from the row below it before the dome detection.
+
+The exposure time and size of each image are taken from its existing JSON, or the EXIF of the image if it doesn't have one (the exposure time is left out if neither has it). The time is taken from the name of the image.
+
+Usage:
+    python reprocess.py out
+    python reprocess.py out/20220407 out/20220408 --workers 4
+
+Author: George Hume
+2022
+'''
+
+### IMPORTS ###
+import cv2 as cv
+import numpy as np
+import argparse
+import copy
+import datetime as dt
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Cfunctions import DomeDetector, SnM_batch, Iprops
+from Efunctions import ephemeris, timescale, observer
+
+VERSION = 2 #change if the JSONs written or the dome detection input change, so they are all redone
+
+##############################################################################################################
+
+def settings_key(settings):
+    ### short hash of the templates and settings the dome detection is done with, saved in each JSON to tell if it is up to date
+    h = hashlib.sha1(f"{VERSION}".encode())
+    for t in settings["templates"]:
+        with open(t,"rb") as f:
+            h.update(f.read())
+    h.update(json.dumps({k:settings[k] for k in ("l1","l2","maxL","mode","calib","prams")},sort_keys=True).encode())
+    return h.hexdigest()[:12]
+
+##############################################################################################################
+
+def find_nights(dirs):
+    ### night directories in dirs, either the nights themselves or directories with nights in them
+    nights = []
+    for d in dirs:
+        d = d.rstrip("/")
+        if re.match(r"\d{8}",os.path.basename(d)):
+            nights.append(d)
+        else:
+            nights += sorted(n for n in glob.glob(f"{d}/*") if os.path.isdir(n) and re.match(r"\d{8}",os.path.basename(n)))
+    return nights
+
+def night_images(night):
+    ### images of a night in the order they were taken (not the placeholders or glances), from the names yyyymmdd_hhmmss_device.ext
+    imgs = []
+    for ext in ("jpg","png"):
+        imgs += glob.glob(f"{night}/[0-9]*_[0-9]*_*.{ext}")
+    return sorted(i for i in imgs if re.match(r"\d{8}_\d{6}_",os.path.basename(i)))
+
+##############################################################################################################
+
+def init(settings):
+    ### sets up a process: loads the ephemerides and the templates once, so every night it does uses the same ones
+    global SETTINGS, DOME, EPH, TS, EPOS
+    SETTINGS = settings
+    EPH, TS = ephemeris(), timescale()
+    p = settings["prams"]
+    EPOS = observer(p["latitude"],p["longitude"],p["elevation"])
+    DOME = DomeDetector(settings["templates"],copy.deepcopy(settings["l1"]),copy.deepcopy(settings["l2"]),settings["maxL"],mode=settings["mode"])
+    if settings["calib"] != None:
+        DOME.calib = [tuple(c) for c in settings["calib"]]
+    cv.setNumThreads(1) #the pool already uses all the cores
+
+##############################################################################################################
+
+def mask_banner(small,width):
+    ### fills in the rows of the annotation banner at the top of small (a downsampled copy of an image width pixels wide) with the row below it, edited in place
+    ## same number of rows as the banner from annotate in Cfunctions (a bit more, to include the edges blurred by the downsampling)
+    rows = int(np.ceil(1.6*max(width/64,12)*small.shape[1]/width))
+    small[:rows] = small[rows]
+    return small
+
+def write_json(fname,values):
+    ### saves a JSON via a temporary file, so a half written one is never left if it is stopped
+    with open(f"{fname}.tmp","w") as fp:
+        json.dump(values,fp,indent=4)
+    os.replace(f"{fname}.tmp",fname)
+
+def reprocess_night(night):
+    ### redoes the JSONs of the images in a night that aren't up to date, returns the night, the number done, skipped and failed, and the time taken
+    st = time.time()
+    key, force, prams = SETTINGS["key"], SETTINGS["force"], SETTINGS["prams"]
+    imgs = night_images(night)
+
+    #existing JSONs and if they are up to date
+    olds, todo = [], []
+    for img in imgs:
+        jname = f"{os.path.splitext(img)[0]}.json"
+        old = None
+        if os.path.exists(jname):
+            try:
+                with open(jname) as f:
+                    old = json.load(f)
+            except ValueError:
+                old = None #half written or broken, so is redone
+        olds.append(old)
+        uptodate = (old != None) and (old.get("reprocess",{}).get("key") == key) and (os.path.getmtime(jname) >= os.path.getmtime(img))
+        todo.append(force or not uptodate)
+    todo = list(np.maximum.accumulate(np.array(todo,dtype=bool))) if len(todo) > 0 else todo #the dome detection state runs on through the night, so everything after an image that is redone is redone too
+
+    ndone, nfail = 0, 0
+    if any(todo):
+        #sun and moon info for all the images to do at once
+        stamps = [re.match(r"(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})",os.path.basename(imgs[i])).groups() for i in range(len(imgs)) if todo[i]]
+        Y, M, D, h, m, s = np.array(stamps,dtype=int).T
+        t = TS.utc(Y,M,D,h,m,s)
+        props = SnM_batch(EPOS,t,EPH)
+
+        #dome detection goes through the night in order, from the start of a night
+        DOME.lims = copy.deepcopy([SETTINGS["l1"],SETTINGS["l2"]])
+        domestatus = True
+        k = 0
+        for img, old, do in zip(imgs,olds,todo):
+            if not do:
+                #carries on from what it was
+                domestatus = (old.get("dome-status") == "Closed")
+                DOME.lims = copy.deepcopy(old["dome-limits"]) #always there, as the key includes VERSION
+                continue
+
+            try:
+                #thumbnail the same size as the glances, decoded at quarter resolution (as the capture script makes them)
+                small = cv.imread(img,cv.IMREAD_REDUCED_GRAYSCALE_4)
+                small = mask_banner(small,4*small.shape[1]) #the glances are taken before the banner is drawn
+                small = cv.resize(small,[825,640],interpolation=cv.INTER_AREA)
+                domestatus = DOME.detect(small,domestatus)
+
+                if (old != None) and ("image" in old):
+                    iprops = [old["image"]["exposure time"],old["image"]["width"],old["image"]["height"]]
+                else:
+                    try:
+                        iprops = Iprops(img) #from the EXIF, only when there is no JSON already
+                    except Exception:
+                        #no EXIF (e.g., saved by OpenCV), so the exposure time isn't known
+                        height, width = cv.imread(img,cv.IMREAD_UNCHANGED).shape[:2]
+                        iprops = [None,width,height]
+
+                p = props[k]
+                fname = os.path.basename(img)
+                values = {"device":prams["device_name"],"time":t[k].utc_strftime("%H:%M:%S"),
+                "image":{"name":fname,"exposure time":iprops[0], "width":iprops[1], "height":iprops[2]},
+                "location":{"name":prams["location"],"latitude":prams["latitude"],"longitude":prams["longitude"],"elevation":prams["elevation"]},
+                          "period of the day":str(p["period"]),
+                          "sun":{"altitude":round(float(p["sun_alt"]),7)},
+                          "moon":{"altitude":round(float(p["moon_alt"]),7),"phase":round(float(p["moon_phase"]),7),
+                          "illumination":round(float(p["moon_ill"]),7)},
+                          "dome-status":"Closed" if domestatus else "Open",
+                          "dome-limits":[[[int(v) for v in r] for r in l] for l in DOME.lims], #so the detection can carry on from this image
+                          "reprocess":{"key":key,"time":dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")}
+                         }
+                if DOME.mode == "ncc":
+                    values["dome-confidence"] = DOME.confidence
+                write_json(f"{os.path.splitext(img)[0]}.json",values)
+                ndone += 1
+            except Exception as e:
+                print(f"ERROR: couldn't reprocess {img}: {e}")
+                nfail += 1
+            k += 1
+
+    return night, ndone, len(imgs)-ndone-nfail, nfail, time.time()-st
+
+##############################################################################################################
+
+if __name__ == "__main__":
+    #command line arguments
+    parser = argparse.ArgumentParser(description = """
+    Reprocesses archived nights: works out the dome status and sun and moon info of every image again and rewrites their JSONs, skipping the ones that are up to date.
+    Author: George Hume
+    2022
+    """)
+    #adding arguments to praser object
+    parser.add_argument('dirs' , type = str, nargs = '+', help = 'Night directories (out/YYYYMMDD), or directories with nights in them (out).')
+    parser.add_argument('--setup' , type = str, help = 'Setup JSON of the device (name and location), as made by the capture script.', default = "setup.json")
+    parser.add_argument('--templates' , type = str, nargs = 2, help = 'Paths to the 2 dome templates.', default = ['dome-templates/hflr-template1.jpg', 'dome-templates/hflr-template2.jpg'])
+    parser.add_argument('--mode' , type = str, choices = ["ncc","limits"], help = 'Dome detection mode of DomeDetector.', default = "ncc")
+    parser.add_argument('--config' , type = str, help = 'JSON file of the dome detection limits to use instead of the ones in the capture script (any of: l1, l2, maxL, and calib for the ncc mode).', default = None)
+    parser.add_argument('--workers' , type = int, help = 'Number of processes used (one per core by default, 1 to not use a pool).', default = os.cpu_count())
+    parser.add_argument('--force' , action = 'store_true', help = 'Redo all the JSONs, even the ones that are up to date.')
+    args = parser.parse_args()
+
+    with open(args.setup) as f:
+        prams = json.load(f)
+
+    #same limits as the capture script
+    settings = {"templates":args.templates,"mode":args.mode,"force":args.force,"prams":prams,"calib":None,
+                "l1":[[104,204],[75,175]],"l2":[[505,506],[6,106]],"maxL":[[[25,325],[25,225]],[[450,735],[0,200]]]}
+    if args.config != None:
+        with open(args.config) as f:
+            settings.update(json.load(f))
+    settings["key"] = settings_key(settings)
+
+    nights = find_nights(args.dirs)
+    if len(nights) == 0:
+        print("ERROR: no night directories (YYYYMMDD) found")
+        exit()
+    print(f"{len(nights)} nights to check (settings {settings['key']})")
+
+    st = time.time()
+    totals = np.zeros(3,dtype=int)
+    if args.workers > 1:
+        with ProcessPoolExecutor(min(args.workers,len(nights)),initializer=init,initargs=(settings,)) as pool:
+            futures = [pool.submit(reprocess_night,n) for n in nights]
+            for future in as_completed(futures): #reported as they finish
+                night, ndone, nskip, nfail, secs = future.result()
+                totals += [ndone,nskip,nfail]
+                print(f"{night}: {ndone} done, {nskip} up to date, {nfail} failed ({secs:.1f} s)")
+    else:
+        init(settings)
+        for n in nights:
+            night, ndone, nskip, nfail, secs = reprocess_night(n)
+            totals += [ndone,nskip,nfail]
+            print(f"{night}: {ndone} done, {nskip} up to date, {nfail} failed ({secs:.1f} s)")
+
+    print(f"{totals[0]} images reprocessed, {totals[1]} up to date and {totals[2]} failed in {time.time()-st:.1f} s")
@@ -0,0 +1,99 @@
+'''
+Asyncio scheduler for running all the tasks of the skyWATCH device (capture, dome polling, sensor readings and astro-info updates) concurrently in a single process.
+
+Each task is a normal (blocking) function which is run in a thread, so the event loop is free to start the other tasks on time while it waits on the camera or the sensors. The function returns how long until it should run again, which lets a task like the capture loop decide for itself (e.g., straight away when the dome is open, a minute later when it is closed).
+
+Deadlines are kept on the monotonic clock and worked out from the previous deadline rather than from when the task finished, so tasks with a fixed period don't drift by however long they took to run, the way a `time.sleep(60)` after the work does.
+
+Usage:
+    sched = Scheduler(logname="scheduler.log")
+    sched.add("capture",cycle) #runs again after however many seconds cycle returns
+    sched.add("sensors",meto,period=600,args=("out/meto.csv",))
+    sched.run()
+
+Author: George Hume
+2022
+'''
+### IMPORTS ###
+import asyncio
+import datetime as dt
+import traceback
+
+##############################################################################################################
+
+class Scheduler:
+    '''
+    RUNS FUNCTIONS AS CONCURRENT TASKS WITH DEADLINES
+
+    Arguments:
+        - logname: optional path to a log file that errors from the tasks are written to (printed if None)
+
+    Tasks:
+        Added with add(name,job,period,offset,args), where job is called with args. The value the job returns sets when it runs next:
+            - None: runs again one period after its last deadline (fixed rate, no drift)
+            - a number: runs again after that many seconds (0 is straight away)
+            - False: task is stopped
+        If a job raises an error it is logged and the job runs again after its period (or after retry seconds if it has no period), so one failed sensor reading doesn't take down the whole device.
+    '''
+
+    def __init__(self,logname=None,retry=60):
+        self.logname = logname
+        self.retry = retry
+        self.jobs = [] #(name, job, period, offset, args) of each task
+        self.runs = {} #number of times each task has run
+        self.late = {} #longest a task has started after its deadline (in seconds)
+
+    def add(self,name,job,period=None,offset=0,args=()):
+        ### adds a task; period is in seconds (None if the job decides when it runs next), offset is the delay before its first run
+        self.jobs.append((name,job,period,offset,args))
+        self.runs[name] = 0
+        self.late[name] = 0.0
+
+    def log(self,string):
+        ### writes to the log, or prints if there is no log
+        string = f"{dt.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} | {string}\n"
+        if self.logname == None:
+            print(string,end="")
+        else:
+            with open(self.logname,'a') as f:
+                f.write(string)
+
+    async def task(self,name,job,period,offset,args):
+        ### runs one job until it is stopped
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + offset
+
+        while True:
+            await asyncio.sleep(max(deadline-loop.time(),0))
+            self.late[name] = max(self.late[name],loop.time()-deadline)
+
+            try:
+                wait = await asyncio.to_thread(job,*args) #blocking job runs in a thread
+            except Exception:
+                self.log(f"task '{name}' failed:\n{traceback.format_exc()}")
+                wait = period if period != None else self.retry
+            self.runs[name] += 1
+
+            if wait is False:
+                self.log(f"task '{name}' stopped")
+                break
+            elif wait == None:
+                if period == None: #job didn't say when to run next and has no period
+                    wait = self.retry
+                else:
+                    deadline += period
+                    if deadline < loop.time(): #overran, so skips the deadlines it missed instead of running back to back
+                        deadline += period*((loop.time()-deadline)//period + 1)
+                    continue
+            deadline = loop.time() + wait
+
+    async def main(self):
+        ### starts all the tasks and waits on them
+        await asyncio.gather(*[self.task(*job) for job in self.jobs])
+
+    def run(self):
+        ### runs the scheduler (blocks until all the tasks are stopped)
+        asyncio.run(self.main())
+
+##############################################################################################################
@@ -2,6 +2,8 @@
 Pfunctions: this contains the functions for use in:
  - fitting.py
  - test.py
+ - lookup.py
+ - platesolve.py
 
 Author: George Hume
 2022
@@ -13,121 +15,194 @@ import skyfield.api as api
 from skyfield.api import N,S,E,W, wgs84,load,Star,utc
 import datetime as dt
 import scipy.optimize as opt
+import scipy.ndimage as ndi
+from scipy.spatial import cKDTree
+import sys
+import os
+import json
+import hashlib
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../Capture"))
+from Efunctions import timescale, observer
 
 ################################################################################
 
-def pixels2polars(x,y):
-    "Converts x and y pixels image coordinates with origin at top left of the image to polar coordinates (r, theta) with origin at the centre on the image. Returns r with units of pixels and theta with units of degrees."
+class Geometry:
+    '''
+    POSITION OF THE OPTICAL CENTRE AND SIZE OF THE IMAGES THE POLAR TRANSFORM IS USED ON
 
-    #middle of the image needs to be (0,0) position so need to offest the coordinates
-    x1 = x - 2028
-    y1 = 1520 - y
-    # (2028,1520) is the centre of the image above
+    Arguments:
+        - centre: (x, y) pixel position of the optical centre, origin at the top left of the image
+        - size: (width, height) of the image in pixels
+        - scale: (x, y) pixels of this image per pixel of the image the fit was made on
+
+    Process:
+        The radial distance, r, from the fits is always in pixels of the image the fit was made on, so a geometry made with resized(size) maps the same calibration onto smaller images (e.g., glances or timelapse frames) without having to rescale the images themselves.
+    '''
+
+    def __init__(self,centre=(2028,1520),size=(4056,3040),scale=(1.0,1.0)):
+        self.centre = (float(centre[0]),float(centre[1]))
+        self.size = (int(size[0]),int(size[1]))
+        self.scale = (float(scale[0]),float(scale[1]))
+
+    def resized(self,size):
+        ### geometry for the same camera after the image is resized to size (width, height), as done with cv.resize
+        sx, sy = size[0]/self.size[0], size[1]/self.size[1]
+        centre = ((self.centre[0]+0.5)*sx - 0.5, (self.centre[1]+0.5)*sy - 0.5) #resize lines up the pixel edges, not centres
+        return Geometry(centre, size, (self.scale[0]*sx, self.scale[1]*sy))
+
+    def todict(self):
+        ### for saving in the JSON file of the fit
+        return {"centre":list(self.centre),"size":list(self.size),"scale":list(self.scale)}
+
+    @classmethod
+    def fromdict(cls,d):
+        ### from the JSON file of the fit
+        return cls(d["centre"],d["size"],d.get("scale",(1.0,1.0)))
+
+    def __repr__(self):
+        return f"Geometry(centre={self.centre}, size={self.size}, scale={self.scale})"
+
+################################################################################
+
+def pixels2polars(x,y,geo=None):
+    "Converts x and y pixels image coordinates with origin at top left of the image to polar coordinates (r, theta) with origin at the optical centre of the image given by geo (a Geometry, by default the centre of a full size image). Returns r with units of pixels (of the image the fit is made on) and theta with units of degrees. x and y can be arrays of any shape (e.g., a grid of every pixel in the image) and r and theta have the same shape."
+
+    if geo == None:
+        geo = Geometry()
+
+    #optical centre needs to be (0,0) position so need to offest the coordinates
+    x1 = (np.asarray(x) - geo.centre[0]) / geo.scale[0]
+    y1 = (geo.centre[1] - np.asarray(y)) / geo.scale[1]
 
     # r in polars is sqrt(x^2+y^2)
-    r = np.sqrt(x1**2+y1**2)
+    r = np.hypot(x1,y1)
 
-    thetas = []
-    for i in range(len(x1)):
-        X,Y = x1[i],y1[i]
-        theta = np.arctan(Y/X)*(180/np.pi) #in degrees
+    theta = np.degrees(np.arctan2(y1,x1)) % 360
+    #angle anticlockwise from the x axis in degrees, arctan2 takes care of the quadrants
+    #and modulo makes sure there are no negative values (0 to 360)
 
-        #make sure no negatives values
-        if (X>0)&(Y>0): #1st quadrant
-            theta = theta
-        elif (X<0)&(Y>0): #2nd quadrant
-            theta = 180+theta
-        elif (X<0)&(Y<0): #3rd quadrant
-            theta = 180+theta
-        else: #4th quadrant
-            theta = 360+theta
+    return r, theta
 
-        thetas.append(theta)
+################################################################################
 
-    return r, np.array(thetas)
+def sexa2dec(values):
+    "Converts an array of (units, minutes, seconds) rows, e.g., RA in h,m,s or dec in d,m,s, to decimal units. Only the sign of the units is used (as in skyfield), so -0 degrees 30 arcmin is -0.5. Arrays that are already decimal (1D) are returned as they are."
+
+    values = np.asarray(values,dtype=float)
+    if values.ndim == 1:
+        return values
+
+    units, minutes, seconds = values[:,0], values[:,1], values[:,2]
+    return np.copysign(np.abs(units) + np.abs(minutes)/60 + np.abs(seconds)/3600, units)
+
+################################################################################
+
+def dec2sexa(values):
+    "Converts an array of decimal units (e.g., RA in hours or dec in degrees) to (n,3) rows of units, minutes, seconds, the inverse of sexa2dec. The sign is kept on the units, as -0.0 if needed."
+
+    values = np.asarray(values,dtype=float)
+    a = np.abs(values)
+    units = np.floor(a)
+    minutes = np.floor((a - units)*60)
+    seconds = (a - units - minutes/60)*3600
+
+    return np.column_stack([np.copysign(units,values),minutes,seconds])
+
+################################################################################
+
+def str2time(times,ts):
+    "Converts an array of 'yyyy/mm/dd hh:mm:ss' strings (UTC) to a single skyfield Time holding all of them."
+
+    times = np.asarray(times,dtype=str)
+    iso = np.char.replace(np.char.replace(np.char.strip(times),'/','-'),' ','T')
+    stamps = iso.astype('datetime64[s]') #raises a ValueError if any of them are in a bad format
+
+    days = stamps.astype('datetime64[D]')
+    months = stamps.astype('datetime64[M]')
+    years = stamps.astype('datetime64[Y]')
+    #splits into the calendar date and the seconds into the day, so skyfield handles the leap seconds
+
+    return ts.utc(years.astype(int) + 1970, months.astype(int) % 12 + 1,
+                  (days - months).astype(int) + 1, 0, 0, (stamps - days).astype(int))
 
 ################################################################################
 
 def radec2azalt(ra,dec,times,lat,long,elv):
     #converts the ra and dec to the az and alt of the target from a given lat, long, elevation
     #and time & date, using the skyfield library
+    #ra and dec are (n,3) arrays of h,m,s and d,m,s (or 1D arrays of decimal hours and degrees)
+    #and times is an array of n 'yyyy/mm/dd hh:mm:ss' strings, so all the stars are done in one go
+
+    ts = timescale()
+    Epos = observer(lat,long,elv)
+    #ephemerides and position are only loaded once
 
-    altitude, azimuth = [],[] #empty lists for alt and az
+    ra, dec = sexa2dec(ra), sexa2dec(dec)
+    times = np.atleast_1d(np.asarray(times,dtype=str))
 
-    for i in range(ra.shape[0]):
-        #loops through each stars RA, dec and time
+    unique, index = np.unique(times, return_inverse=True)
+    #stars are usually measured from a few images, so there are only a few different times
 
-        star =  Star(ra_hours=(ra[i][0], ra[i][1], ra[i][2]),
-                   dec_degrees=(dec[i][0], dec[i][1], dec[i][2]))
-        #creates star oject from ra and dec
+    try:
+        #one time object for all the times the stars were observed
+        t = str2time(unique,ts)
+    except ValueError:
+        bad = [i for i in range(len(times)) if not _goodtime(times[i])]
+        print(f"Bad format of time and date on entry {bad[0] if bad else '?'} of the CSV file. Please correct this and then try again.")
+        exit()
 
-        eph = load('de421.bsp')
-        ts = load.timescale()
-        earth= eph['earth']
-        Epos = earth + wgs84.latlon(lat * N, long * E, elevation_m=elv)
-        #loads position
+    altitude, azimuth = np.empty(ra.shape[0]), np.empty(ra.shape[0])
 
-        try:
-            #creates datetime object for the time the star was observed
-            time = dt.datetime(int(times[i][0:4]), int(times[i][5:7]), int(times[i][8:10]),int(times[i][11:13]),int(times[i][14:16]),int(times[i][17:]),tzinfo=utc)
-        except:
-            print(f"Bad format of time and date on entry {i} of the CSV file. Please correct this and then try again.")
-            exit()
+    for i in range(len(unique)):
+        #skyfield can't pair n stars with n times (it does every star at every time), so the
+        #stars are observed together for each time; this is one call if they share a time
+        sel = (index == i)
+        star = Star(ra_hours=ra[sel], dec_degrees=dec[sel]) #one star object holding all of them
 
-        astro = Epos.at(ts.utc(time)).observe(star)
-        app = astro.apparent()
-        #observers star at time from position
+        alt, az, distance = Epos.at(t[i]).observe(star).apparent().altaz()
+        #observes the stars from position and gets the altitude and azimuth
 
-        alt, az, distance = app.altaz()
-        #gets the altitude and azimuth
+        altitude[sel], azimuth[sel] = alt.degrees, az.degrees
+        #in decimal degrees
 
-        altitude.append(alt.degrees)
-        azimuth.append(az.degrees)
-        #convert into decimal degrees and append to lists
+    return altitude, azimuth #return alt and az as np arrays
 
-    return np.array(altitude), np.array(azimuth) #return alt and az as np arrays
+def _goodtime(time):
+    #checks a single time string (only used to report which entry is bad)
+    try:
+        dt.datetime.strptime(str(time).strip(),"%Y/%m/%d %H:%M:%S")
+        return True
+    except ValueError:
+        return False
 
 ################################################################################
 
 def pa2az(theta):
     #converts the polar angle, theta to the same reference frame as the azimuth as for theta 0 degrees is in WEST and for azimuth zero degrees is at NORTH
-    newpa = []
-
-    for i in theta:
-        if i >= 90:
-            npa = i-90
-        else:
-            npa = i+270
-        newpa.append(npa)
-
-    return np.array(newpa)
+    #works on arrays of any shape
+    return (np.asarray(theta) - 90) % 360
 
 ################################################################################
 
 def polar_angle(tht):
     #function to convert tht back to frame of polar angle
-    PAs = []
-    for i in tht:
-        if i <= 270:
-            theta = i+90
-        else:
-            theta = i-270
-
-        PAs.append(theta)
-
-    return np.array(PAs)
+    #works on arrays of any shape
+    return (np.asarray(tht) + 90) % 360
 
 ################################################################################
 
-def rt2pcoords(r,theta):
-    ##function to convert r and theta to pixels coords on image
-    #convert to cartesians with origin at image centre
+def rt2pcoords(r,theta,geo=None):
+    ##function to convert r and theta to pixels coords on image, geo is the Geometry of the image (full size by default)
+    if geo == None:
+        geo = Geometry()
+
+    #convert to cartesians with origin at the optical centre
     x=r*np.cos(theta*(np.pi/180))
     y=r*np.sin(theta*(np.pi/180)) #need to convert theta to radians
 
     #convert cartesians to have origin at top left
-    x0 = x+2028
-    y0 = 1520-y
+    x0 = geo.centre[0] + geo.scale[0]*x
+    y0 = geo.centre[1] - geo.scale[1]*y
 
     return x0,y0
 
@@ -169,3 +244,324 @@ def fitfunc(X,z,C,name):
         return opt.curve_fit(cosine,X,z,p0=C)
 
 ################################################################################
+
+## functions that can be used for the r-alt fit and its coefficents
+functions = {"linear":linear, "quadratic":quadratic, "cubic":cubic, "cosine":cosine}
+
+## derivatives of the functions above with respect to their coefficents a, b, c, d (for the fitting)
+gradients = {"linear":lambda x,a,b,c,d: [np.ones_like(x),x,np.zeros_like(x),np.zeros_like(x)],
+"quadratic":lambda x,a,b,c,d: [np.ones_like(x),x,x**2,np.zeros_like(x)],
+"cubic":lambda x,a,b,c,d: [np.ones_like(x),x,x**2,x**3],
+"cosine":lambda x,a,b,c,d: [np.cos(b*x*(np.pi/180)),-a*x*(np.pi/180)*np.sin(b*x*(np.pi/180)),np.ones_like(x),np.zeros_like(x)]}
+
+################################################################################
+
+def ralt_jacobian(alt,theta,P,rfunc,cfunc):
+    #value and jacobian (n by the number of parameters) of r for the parameters P of the r-alt fit, with coefficents that depend on theta (cfunc) or not ("constant")
+    alt, theta = np.asarray(alt,dtype=float), np.asarray(theta,dtype=float)
+
+    if cfunc == "constant":
+        coeffs = [np.full(alt.shape,P[j]) for j in range(4)]
+        dcoeffs = [[np.ones(alt.shape)] for j in range(4)] #each coefficent is just its parameter
+    else:
+        coeffs = [functions[cfunc](theta,*P[4*j:4*j+4]) for j in range(4)]
+        dcoeffs = [gradients[cfunc](theta,*P[4*j:4*j+4]) for j in range(4)]
+
+    R = functions[rfunc](alt,*coeffs)
+    dR = gradients[rfunc](alt,*coeffs)
+
+    #chain rule: dR/dP = dR/dcoefficent * dcoefficent/dP
+    J = np.column_stack([dR[j]*dc for j in range(4) for dc in dcoeffs[j]])
+
+    return R, J
+
+################################################################################
+
+def fitralt(alt,theta,r,rfunc,cfunc,p0):
+    '''
+    FITS THE RADIAL DISTANCE TO THE ALTITUDE (AND POLAR ANGLE)
+
+    Arguments:
+        - alt, theta, r: altitudes, polar angles and radial distances of the stars
+        - rfunc: function of the altitude (linear, quadratic, cubic or cosine)
+        - cfunc: function of theta for each coefficent of rfunc (constant, linear, quadratic, cubic or cosine)
+        - p0: starting guess of the parameters (4 for constant, 16 otherwise), also the value of parameters that don't change the fit
+
+    Returns:
+        - the fitted parameters and their covariance (NaN for the ones that don't change the fit), as curve_fit does
+
+    Process:
+        When neither function is a cosine, r is linear in the parameters, so the jacobian is the design matrix and the fit is a single np.linalg.lstsq (no starting guess needed). Otherwise a least squares fit from p0 is used with the analytic jacobian from ralt_jacobian, instead of the finite differences of curve_fit.
+    '''
+    P = np.array(p0,dtype=float).ravel()
+    r = np.asarray(r,dtype=float)
+
+    R, J = ralt_jacobian(alt,theta,P,rfunc,cfunc)
+    used = np.any(J != 0,axis=0) #parameters that aren't in the function (e.g., d for quadratic) are left as they are
+
+    if "cosine" not in (rfunc,cfunc):
+        scale = np.linalg.norm(J[:,used],axis=0) #columns range from 1 to theta^3 alt^3, so they're normalised first
+        P[used] = np.linalg.lstsq(J[:,used]/scale,r,rcond=None)[0]/scale
+    else:
+        def residuals(Q):
+            P[used] = Q
+            return ralt_jacobian(alt,theta,P,rfunc,cfunc)[0] - r
+        def jacobian(Q):
+            P[used] = Q
+            return ralt_jacobian(alt,theta,P,rfunc,cfunc)[1][:,used]
+        P[used] = opt.least_squares(residuals,P[used],jac=jacobian,x_scale="jac",method="lm" if r.size >= used.sum() else "trf").x
+
+    #covariance of the parameters, as curve_fit
+    R, J = ralt_jacobian(alt,theta,P,rfunc,cfunc)
+    cov = np.full((P.size,P.size),np.nan)
+    dof = max(r.size - used.sum(),1)
+    cov[np.ix_(used,used)] = np.linalg.pinv(J[:,used].T @ J[:,used]) * np.sum((R-r)**2)/dof
+
+    return P, cov
+
+################################################################################
+
+def ralt(alt,theta,fit):
+    #radial distance from the r-alt fit (the "r-alt fit" dict of the JSON file from fitting.py) for the altitude and polar angle
+    coeffs = fit["fitted coeffients"]
+    cfunc = fit.get("coefficent function","constant") #older fit files only have constant coefficents
+
+    if cfunc == "constant":
+        return functions[fit["function"]](alt,*coeffs[0:4])
+    else:
+        #coefficents vary with theta, same as newfunc in fitting.py
+        A, B, C, D = [functions[cfunc](theta,*coeffs[4*i:4*i+4]) for i in range(4)]
+        return functions[fit["function"]](alt,A,B,C,D)
+
+################################################################################
+
+def polar_fit(width,height,lat,long,elv):
+    #a fit (same layout as the JSON file from fitting.py) for a plain polar sky map of width by height pixels, that can be used in place of one for a camera
+    #the altitude goes down evenly from the zenith at the centre to the horizon at the sides, with north at the top and east on the left (looking up, the same as virtualsky's polar projection)
+    return {"theta-az fit":{"function":"linear","fitted coeffients":[0,1,0,0]},
+            "r-alt fit":{"function":"linear","coefficent function":"constant","fitted coeffients":[width/2,-width/180,0,0]},
+            "device info":{"lat":lat,"long":long,"elv":elv},
+            "geometry":Geometry(((width-1)/2,(height-1)/2),(width,height)).todict()}
+
+################################################################################
+
+def altaz2pixels(alt,az,prams,geo=None):
+    #pixel positions of the altitudes and azimuths (arrays of any shape) from the fit prams (the dict of the JSON file from fitting.py)
+    #geo is the Geometry of the image, the one saved with the fit by default
+    if geo == None:
+        geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+
+    TA = prams["theta-az fit"]["fitted coeffients"]
+    theta = polar_angle(linear(np.asarray(az),*TA)) #polar angle from the azimuth
+    r = ralt(np.asarray(alt),theta,prams["r-alt fit"])
+
+    return rt2pcoords(r,theta,geo)
+
+################################################################################
+
+def pixels2altaz(x,y,prams,geo=None,iterations=26):
+    #altitudes and azimuths of the pixel positions (arrays of any shape) from the fit prams, NaN for pixels below the horizon
+    #(and 90 for pixels closer to the centre than the zenith of the fit)
+    #the r-alt fit can't be inverted directly for all the functions, so the altitude is found by bisection between 0 and 90 degrees
+    #(26 iterations is better than 1e-5 degrees)
+    if geo == None:
+        geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+
+    r, theta = pixels2polars(x,y,geo)
+
+    TA = prams["theta-az fit"]["fitted coeffients"]
+    az = (((pa2az(theta) - TA[0]) % 360) / TA[1]) % 360 #inverse of the theta-az fit
+
+    lo, hi = np.zeros(r.shape), np.full(r.shape,90.0)
+    horizon, zenith = ralt(lo,theta,prams["r-alt fit"]), ralt(hi,theta,prams["r-alt fit"])
+    valid = ((r - horizon) * (zenith - horizon) >= 0) #pixel is above the horizon
+    r = np.where((r - zenith) * (zenith - horizon) > 0, zenith, r) #fit might not quite reach the centre, so those pixels are the zenith
+    flo = horizon - r
+
+    for i in range(iterations):
+        mid = (lo + hi) / 2
+        fmid = ralt(mid,theta,prams["r-alt fit"]) - r
+        left = (flo * fmid <= 0) #altitude is in the lower half
+        hi = np.where(left,mid,hi)
+        lo, flo = np.where(left,lo,mid), np.where(left,flo,fmid)
+
+    alt = (lo + hi) / 2
+    alt[~valid] = np.nan
+    az = np.where(valid,az,np.nan)
+
+    return alt, az
+
+################################################################################
+
+def lookup_tables(json_path,size=None,step=0.1,cache="lut",chunk=256):
+    '''
+    PER-PIXEL ALT/AZ (AND INVERSE X/Y) LOOKUP TABLES FROM A FIT, CACHED ON DISK
+
+    Arguments:
+        - json_path: path to the JSON file from fitting.py
+        - size: (width, height) of the images the tables are for (size of the reference images by default)
+        - step: step in degrees of the alt/az grid of the inverse tables
+        - cache: directory the tables are saved in
+        - chunk: number of rows of the image worked out at a time (limits the memory used)
+
+    Returns:
+        - dict of read-only memory-mapped float32 arrays:
+            - "alt", "az": (height, width) altitude and azimuth of each pixel in degrees (NaN below the horizon)
+            - "x", "y": (nalt, naz) pixel position of each altitude and azimuth on the grid alt = i*step (0 to 90), az = j*step (0 to 360)
+
+    Process:
+        The tables are named by a hash of the fit file, the size and the step, so they are only worked out the first time and are remade whenever the fit changes. They are written to a temporary file and renamed once finished, so a process reading the cache never sees half a table.
+    '''
+    with open(json_path,'rb') as f:
+        raw = f.read()
+    prams = json.loads(raw)
+
+    geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+    if size != None:
+        geo = geo.resized(size)
+    width, height = geo.size
+
+    key = f"{hashlib.sha1(raw).hexdigest()[:16]}-{width}x{height}-{step:g}"
+    names = {n:os.path.join(cache,f"{key}-{n}.npy") for n in ["alt","az","x","y"]}
+
+    if not all(os.path.exists(p) for p in names.values()):
+        os.makedirs(cache,exist_ok=True)
+        tmp = {n:f"{p}.{os.getpid()}.tmp" for n,p in names.items()}
+
+        #per-pixel altitude and azimuth, a chunk of rows at a time straight into the files
+        alt = np.lib.format.open_memmap(tmp["alt"],mode="w+",dtype=np.float32,shape=(height,width))
+        az = np.lib.format.open_memmap(tmp["az"],mode="w+",dtype=np.float32,shape=(height,width))
+        xs = np.arange(width)
+        for row in range(0,height,chunk):
+            y, x = np.meshgrid(np.arange(row,min(row+chunk,height)),xs,indexing="ij")
+            alt[row:row+chunk], az[row:row+chunk] = pixels2altaz(x,y,prams,geo)
+        alt.flush(); az.flush()
+        del alt, az
+
+        #pixel position of each altitude and azimuth
+        A, Z = np.meshgrid(np.arange(0,90+step/2,step),np.arange(0,360,step),indexing="ij")
+        x, y = altaz2pixels(A,Z,prams,geo)
+        for n, table in [("x",x),("y",y)]:
+            with open(tmp[n],'wb') as f:
+                np.save(f,table.astype(np.float32))
+
+        for n in names:
+            os.replace(tmp[n],names[n])
+
+    return {n:np.load(p,mmap_mode="r") for n,p in names.items()}
+
+################################################################################
+
+def detect_sources(img,nsigma=5,box=7,maxsources=500,banner=0):
+    '''
+    FINDS POINT SOURCES (STARS) IN AN IMAGE
+
+    Arguments:
+        - img: greyscale image as a 2D array
+        - nsigma: how many times the noise above the local background a peak needs to be
+        - box: size in pixels of the box a peak needs to be the maximum of (and the centroid is worked out in)
+        - maxsources: only the brightest this many are returned
+        - banner: number of rows at the top of the image to ignore (the annotation banner)
+
+    Returns:
+        - x, y: centroids of the sources in pixels (origin at the top left)
+        - flux: background subtracted flux of the sources
+
+    Process:
+        The local background (mean in a box 4 times bigger) is subtracted and the noise estimated from the median absolute deviation. Peaks are pixels that are the maximum in their box and above the threshold, and their centroids are the flux weighted means of the box around them, all done with array operations rather than looping over the pixels.
+    '''
+    img = np.asarray(img,dtype=np.float32)
+    res = img - ndi.uniform_filter(img,4*box+1) #background subtracted
+
+    sample = res[banner::4,::4] #noise from every 4th pixel is plenty
+    noise = 1.4826*np.median(np.abs(sample - np.median(sample)))
+
+    peaks = (res == ndi.maximum_filter(res,box)) & (res > nsigma*max(noise,1e-6))
+    peaks[:max(banner,box),:], peaks[-box:,:], peaks[:,:box], peaks[:,-box:] = False, False, False, False
+    #ignores the banner and the edges (so the boxes are inside the image)
+    ys, xs = np.nonzero(peaks)
+
+    order = np.argsort(res[ys,xs])[::-1][:maxsources] #brightest first
+    ys, xs = ys[order], xs[order]
+
+    h = box//2
+    dy, dx = np.mgrid[-h:h+1,-h:h+1]
+    cut = np.clip(res[ys[:,None,None]+dy, xs[:,None,None]+dx],0,None) #box around each peak
+    flux = cut.sum(axis=(1,2))
+
+    x = xs + (cut*dx).sum(axis=(1,2))/flux
+    y = ys + (cut*dy).sum(axis=(1,2))/flux
+
+    return x, y, flux
+
+################################################################################
+
+def match_sources(x1,y1,x2,y2,radius):
+    #matches two lists of positions (e.g., detected sources and predicted positions of stars), returns the indices (i1, i2) of the pairs
+    #pairs are each others nearest neighbour and closer than radius, so crowded areas don't get matched twice
+    if len(x1) == 0 or len(x2) == 0:
+        return np.array([],dtype=int), np.array([],dtype=int)
+
+    p1, p2 = np.column_stack([x1,y1]), np.column_stack([x2,y2])
+    d12, n12 = cKDTree(p2).query(p1,distance_upper_bound=radius) #nearest of 2 for each of 1
+    d21, n21 = cKDTree(p1).query(p2) #nearest of 1 for each of 2
+
+    i1 = np.nonzero(np.isfinite(d12))[0]
+    i2 = n12[i1]
+    mutual = (n21[i2] == i1)
+
+    return i1[mutual], i2[mutual]
+
+################################################################################
+
+def refit(prams,alt,az,x,y,memory=50,f_scale=3):
+    '''
+    UPDATES A FIT WITH NEW MATCHED STARS
+
+    Arguments:
+        - prams: the fit (dict of the JSON file from fitting.py)
+        - alt, az: altitudes and azimuths of the matched stars
+        - x, y: their pixel positions, in pixels of the reference images of the fit
+        - memory: how many stars the old fit is worth
+        - f_scale: residual in pixels above which stars count less (so bad matches don't drag the fit)
+
+    Returns:
+        - the updated fit (a new dict, same layout as the JSON file) and the rms residual of the stars in pixels
+
+    Process:
+        Starts from the current parameters (optical centre, theta-az and r-alt fit) rather than from scratch, and fits the pixel residuals of the stars together with a grid of points across the sky at the positions the old fit puts them. The grid is weighted to count as memory stars, so a night with a few matches moves the fit a little while drift that shows up night after night is followed.
+    '''
+    geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+    TA = prams["theta-az fit"]["fitted coeffients"]
+    coeffs = prams["r-alt fit"]["fitted coeffients"]
+
+    P0 = np.concatenate([geo.centre,TA[0:2],coeffs]).astype(float)
+
+    def unpack(P):
+        #fit dict from the parameters
+        new = json.loads(json.dumps(prams)) #copy
+        new["geometry"] = Geometry(P[0:2],geo.size).todict()
+        new["theta-az fit"]["fitted coeffients"] = [float(P[2]),float(P[3])] + list(TA[2:])
+        new["r-alt fit"]["fitted coeffients"] = [float(c) for c in P[4:]]
+        return new
+
+    #points across the sky at the positions the old fit puts them
+    A, Z = np.meshgrid(np.arange(15,90,15),np.arange(0,360,30))
+    A, Z = A.ravel(), Z.ravel()
+    xa, ya = altaz2pixels(A,Z,prams,geo)
+    w = np.sqrt(memory/A.size)
+
+    def residuals(P):
+        new = unpack(P)
+        X, Y = altaz2pixels(alt,az,new)
+        XA, YA = altaz2pixels(A,Z,new)
+        return np.concatenate([X-x, Y-y, w*(XA-xa), w*(YA-ya)])
+
+    sol = opt.least_squares(residuals,P0,x_scale="jac",loss="soft_l1",f_scale=f_scale)
+
+    n = len(alt)
+    rms = np.sqrt(np.mean(sol.fun[0:n]**2 + sol.fun[n:2*n]**2))
+
+    return unpack(sol.x), rms
+
+################################################################################
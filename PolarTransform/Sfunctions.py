@@ -0,0 +1,246 @@
+'''
+Sfunctions: the bright-star catalogue bundled with skyWATCH (bright-stars.npz, made by make-catalogue.py) and the constellation overlay drawn with it, for use in:
+ - platesolve.py
+ - test.py
+ - c2v/overlay.py and c2v/geo-correct/map-resize.py
+
+The catalogue is stored sorted into a grid of cells on the sky (bands of declination split into cells of RA) with the index of the first star in each cell, so finding the stars near a position or above the horizon only looks at the cells that could have them in, and the rest is done with arrays.
+
+Usage:
+    cat = StarCatalogue()
+    stars, alt, az = cat.visible(t,lat,long,elv,minalt=10,maxmag=4.5)
+
+    overlay = Overlay(prams,size=(825,640)) #prams is a fit from fitting.py
+    overlay.draw(img,t)
+
+Author: George Hume
+2022
+'''
+
+import numpy as np
+import cv2 as cv
+import os
+import sys
+from skyfield.api import Star
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../Capture"))
+from Efunctions import observer
+from Pfunctions import Geometry, altaz2pixels
+
+## path to the bundled catalogue
+catalogue_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"bright-stars.npz")
+
+## path to the constellation lines (the modern western ones from Stellarium, as pairs of HIP numbers)
+## copied from Stellarium's skycultures/western/constellationship.fab (GNU GPL v2 or later, see the README)
+lines_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"constellationship.fab")
+
+## layout of the rows of the catalogue
+star_dtype = np.dtype([("hip","<u4"),("ra","<f4"),("dec","<f4"),("mag","<f4")]) #HIP number, RA in hours, dec in degrees, V magnitude
+
+################################################################################
+
+def unitvec(ra,dec):
+    #unit vectors (n,3) pointing at RA (hours) and dec (degrees)
+    ra, dec = np.radians(np.asarray(ra,dtype=float)*15), np.radians(np.asarray(dec,dtype=float))
+    return np.stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)],axis=-1)
+
+################################################################################
+
+def make_grid(stars,step=10):
+    #sorts the stars into cells of step by step degrees (bands of dec split up in RA), returns the sorted stars and the index of the first star in each cell
+    nra, ndec = int(round(360/step)), int(round(180/step))
+
+    i = np.clip(((stars["dec"] + 90)//step).astype(int),0,ndec-1) #dec band
+    j = np.clip(((stars["ra"]*15)//step).astype(int),0,nra-1) #RA cell in the band
+    cell = i*nra + j
+
+    order = np.argsort(cell,kind="stable")
+    start = np.searchsorted(cell[order],np.arange(nra*ndec+1)) #stars of cell c are start[c]:start[c+1]
+
+    return stars[order], start.astype(np.int32)
+
+################################################################################
+
+def read_lines(fname=lines_path):
+    #reads constellation lines in the Stellarium constellationship.fab format (abbreviation, number of lines, then the HIP numbers of the two ends of each line)
+    #returns the abbreviation of the constellation of each line and the (n,2) HIP numbers of the ends
+    names, pairs = [], []
+    with open(fname) as f:
+        for row in f:
+            row = row.split()
+            if len(row) < 2:
+                continue
+            hips = np.array(row[2:],dtype=np.uint32).reshape(-1,2)
+            names += [row[0]]*len(hips)
+            pairs.append(hips)
+
+    return np.array(names), np.concatenate(pairs)
+
+################################################################################
+
+class StarCatalogue:
+    '''
+    BRIGHT-STAR CATALOGUE WITH A GRID INDEX ON RA AND DEC
+
+    Arguments:
+        - fname: path to the catalogue (the bundled one by default)
+        - maxmag: only keep stars brighter than this (all of them if None)
+
+    Attributes:
+        - stars: structured array of the stars with the fields hip, ra (hours), dec (degrees) and mag
+        - start: index of the first star in each cell of the grid
+        - step: size of the cells in degrees
+    '''
+
+    def __init__(self,fname=catalogue_path,maxmag=None):
+        with np.load(fname) as data:
+            self.stars = data["stars"]
+            self.start = data["start"]
+            self.step = float(data["step"])
+
+        if maxmag != None:
+            #rows are kept in cell order, so the index just needs counting again
+            keep = self.stars["mag"] <= maxmag
+            kept = np.concatenate([[0],np.cumsum(keep)]) #number of stars kept before each row
+            self.stars = self.stars[keep]
+            self.start = kept[self.start].astype(np.int32)
+
+        self.nra, self.ndec = int(round(360/self.step)), int(round(180/self.step))
+        self.vec = unitvec(self.stars["ra"],self.stars["dec"]) #for the distances between stars and positions
+
+        #centre of each cell and the furthest its corners are from the centre (so a cell can be skipped if it is all too far away)
+        i, j = np.divmod(np.arange(self.nra*self.ndec),self.nra)
+        self.cdec = -90 + (i+0.5)*self.step
+        self.cra = (j+0.5)*self.step/15
+        corners = [unitvec(self.cra+dj*self.step/30, self.cdec+di*self.step/2) for di in (-1,1) for dj in (-1,1)]
+        centre = unitvec(self.cra,self.cdec)
+        self.cradius = np.max([np.degrees(np.arccos(np.clip(np.sum(c*centre,axis=1),-1,1))) for c in corners],axis=0)
+
+    def __len__(self):
+        return len(self.stars)
+
+    def cone(self,ra,dec,radius):
+        ### indices of the stars within radius degrees of RA (hours) and dec (degrees)
+        centre = unitvec(ra,dec)
+
+        #cells that could have stars in the cone
+        dist = np.degrees(np.arccos(np.clip(unitvec(self.cra,self.cdec) @ centre,-1,1)))
+        cells = np.nonzero(dist <= radius + self.cradius)[0]
+        index = np.concatenate([np.arange(self.start[c],self.start[c+1]) for c in cells] + [np.array([],dtype=int)])
+
+        #stars in those cells that are in the cone
+        inside = (self.vec[index] @ centre) >= np.cos(np.radians(radius))
+        return index[inside]
+
+    def visible(self,t,lat,long,elv,minalt=0,maxmag=None):
+        ### stars above minalt degrees at the skyfield Time t from lat, long (decimal degrees) and elv (metres), returns the rows of the catalogue and their altitudes and azimuths in degrees
+        zenith = (t.gast + long/15) % 24 #RA of the zenith is the local sidereal time
+
+        index = self.cone(zenith,lat,90-minalt+1) #1 degree spare for refraction and the shape of the earth
+        if maxmag != None:
+            index = index[self.stars["mag"][index] <= maxmag]
+        stars = self.stars[index]
+
+        alt, az, distance = observer(lat,long,elv).at(t).observe(Star(ra_hours=stars["ra"].astype(float),dec_degrees=stars["dec"].astype(float))).apparent().altaz()
+        #all the stars at once
+
+        above = alt.degrees > minalt
+        return stars[above], alt.degrees[above], az.degrees[above]
+
+################################################################################
+
+class Overlay:
+    '''
+    DRAWS THE CONSTELLATIONS AND BRIGHT STARS ONTO IMAGES THROUGH A FIT FROM FITTING.PY
+
+    Arguments:
+        - prams: the fit (dict of the JSON file from fitting.py, or polar_fit for a plain sky map)
+        - size: (width, height) of the images drawn on (size of the reference images of the fit by default)
+        - maxmag: faintest stars drawn
+        - segments: each constellation line is split into this many pieces, so the lines bend with the lens
+        - catalogue: the StarCatalogue (the bundled one by default)
+        - lines: path to the constellation lines
+
+    Process:
+        Everything that doesn't change with time (the points along each line as RA and dec, which lines go to which stars) is worked out once. draw() then works out the altitude and azimuth of every point and star above the horizon in one skyfield call, puts them on the image with the fit, and draws all the lines in one cv.polylines call and all the stars in one cv.fillPoly call, so it can be done for every frame offline.
+    '''
+
+    def __init__(self,prams,size=None,maxmag=4.5,segments=8,catalogue=None,lines=lines_path):
+        self.prams = prams
+        self.device = prams["device info"]
+        geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+        self.geo = geo if size == None else geo.resized(size)
+        self.maxmag = maxmag
+        self.cat = StarCatalogue() if catalogue == None else catalogue
+
+        #ends of each line in the catalogue (lines to stars not in it are left out)
+        names, pairs = read_lines(lines)
+        order = np.argsort(self.cat.stars["hip"])
+        pos = np.clip(np.searchsorted(self.cat.stars["hip"],pairs,sorter=order),0,len(order)-1)
+        ends = order[pos]
+        found = np.all(self.cat.stars["hip"][ends] == pairs,axis=1)
+        self.names, ends = names[found], ends[found]
+
+        #points along each line (along the great circle between its ends)
+        a, b = self.cat.vec[ends[:,0]], self.cat.vec[ends[:,1]]
+        f = np.linspace(0,1,segments+1)[None,:,None]
+        points = a[:,None,:]*(1-f) + b[:,None,:]*f
+        points /= np.linalg.norm(points,axis=2,keepdims=True)
+        self.points = points #(lines, segments+1, 3) unit vectors
+
+        self.lra = (np.degrees(np.arctan2(points[...,1],points[...,0]))/15) % 24
+        self.ldec = np.degrees(np.arcsin(np.clip(points[...,2],-1,1)))
+
+        #scale of the drawing with the size of the image (like the banner from annotate)
+        self.scale = max(self.geo.size[0]/1000,0.5)
+
+    def positions(self,t):
+        ### pixel positions of the lines and bright stars at the skyfield Time t
+        ## returns the (n, segments+1, 2) points of the lines above the horizon, their constellations, and the x, y and magnitudes of the stars above the horizon
+        lat, long, elv = self.device["lat"], self.device["long"], self.device["elv"]
+
+        #lines and stars that could be above the horizon
+        zenith = unitvec((t.gast + long/15) % 24,lat)
+        lines = np.nonzero(np.min(self.points @ zenith,axis=1) > -0.02)[0]
+        stars = self.cat.cone((t.gast + long/15) % 24,lat,91)
+        stars = stars[self.cat.stars["mag"][stars] <= self.maxmag]
+
+        #altitude and azimuth of all of them in one go
+        ra = np.concatenate([self.lra[lines].ravel(),self.cat.stars["ra"][stars]])
+        dec = np.concatenate([self.ldec[lines].ravel(),self.cat.stars["dec"][stars]])
+        alt, az, distance = observer(lat,long,elv).at(t).observe(Star(ra_hours=ra.astype(float),dec_degrees=dec.astype(float))).apparent().altaz()
+        x, y = altaz2pixels(alt.degrees,az.degrees,self.prams,self.geo)
+
+        n = self.points.shape[1]*len(lines)
+        lalt = alt.degrees[:n].reshape(len(lines),-1)
+        above = np.all(lalt > 0,axis=1) #lines that are all above the horizon
+        pts = np.stack([x[:n],y[:n]],axis=1).reshape(len(lines),-1,2)[above]
+
+        salt = alt.degrees[n:]
+        sabove = salt > 0
+
+        return pts, self.names[lines][above], x[n:][sabove], y[n:][sabove], self.cat.stars["mag"][stars][sabove]
+
+    def draw(self,img,t,lines=True,stars=True,labels=True,colour=(255,180,60),scolour=(255,255,255)):
+        ### draws the overlay on img (edited in place) for the skyfield Time t, colours are BGR (or a number for greyscale images)
+        pts, names, x, y, mag = self.positions(t)
+        shift = 4 #draws at 1/16 of a pixel
+
+        if lines and len(pts) > 0:
+            cv.polylines(img,np.round(pts*2**shift).astype(np.int32),False,colour,max(int(self.scale),1),cv.LINE_AA,shift)
+
+        if stars and len(x) > 0:
+            #dots as octagons (all the same number of corners, so they can be filled in one call), bigger for brighter stars
+            radius = self.scale*(1 + 0.6*(self.maxmag - mag))
+            angles = np.linspace(0,2*np.pi,8,endpoint=False)
+            dots = np.stack([x[:,None] + radius[:,None]*np.cos(angles), y[:,None] + radius[:,None]*np.sin(angles)],axis=2)
+            cv.fillPoly(img,np.round(dots*2**shift).astype(np.int32),scolour,cv.LINE_AA,shift)
+
+        if labels and len(pts) > 0:
+            #name of each constellation at the middle of its lines
+            for name in np.unique(names):
+                cx, cy = pts[names == name].reshape(-1,2).mean(axis=0)
+                cv.putText(img,name,(int(cx),int(cy)),cv.FONT_HERSHEY_SIMPLEX,0.5*self.scale,colour,max(int(self.scale),1),cv.LINE_AA)
+
+        return img
+
+################################################################################
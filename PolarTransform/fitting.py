@@ -11,6 +11,8 @@ You can specify the kind of functions used to fit the radial distance, r, of the
 
     You can also specifiy if you want the above coefficents to depend on the polar angle, ϑ. I.e., r also depends on the azimuth of the source. The options for these functions that map ϑ to the coeffients are the same as for r, plus constant (i.e., no dependency). The functions will be the same for all coeffients.
 
+The optical centre of the camera is not exactly at the centre of the image, so its x and y position are fitted as two extra free parameters alongside the coefficents (pass --fixcentre to keep it at the starting guess). The centre and size of the reference images are saved with the fit, so it can be used on resized images (e.g., glances) too.
+
 The coeffients for all these all these fits will be outputted as a JSON file.
 
 Author: George Hume
@@ -39,6 +41,9 @@ parser.add_argument('elv' , type = float, help = 'Elevation above sea-level of t
 parser.add_argument('rfunc' , type = str, help = 'Function to fit alt to r. Options are: linear, quadratic, cubic, cosine, or power.')
 parser.add_argument('cfunc' , type = str, help = 'Function to fit the coefficents of r fucntion and the polar angle. Options are: constant, linear, quadratic, cubic, cosine, or power.')
 parser.add_argument('--show' , type = bool, help = 'If set to true this will display some graphs related to the fitting.', default = False)
+parser.add_argument('--size' , type = int, nargs = 2, help = 'Width and height in pixels of the reference images.', default = [4056,3040])
+parser.add_argument('--centre' , type = float, nargs = 2, help = 'Starting guess of the x and y pixel position of the optical centre (centre of the image by default).', default = None)
+parser.add_argument('--fixcentre' , action = 'store_true', help = 'Keep the optical centre at the starting guess instead of fitting it.')
 args = parser.parse_args()
 
 ## checking functions asked for are valid
@@ -69,8 +74,13 @@ except:
 ## seperate position into x and y coords
 x,y = pos.T[0], pos.T[1]
 
+## starting geometry of the reference images
+if args.centre == None:
+    args.centre = [args.size[0]/2, args.size[1]/2]
+geo = Geometry(args.centre,args.size)
+
 ## convert to polars
-r, theta = pixels2polars(x,y)
+r, theta = pixels2polars(x,y,geo)
 
 ## convert RA and DEC to ALT and AZ
 ALT, AZ = radec2azalt(RA,DEC,times,args.lat,args.long,args.elv)
@@ -88,13 +98,13 @@ ATa, ATb, ATc, ATd = AT_results[0][0], AT_results[0][1],0,0 #coefficents of the
 
 #dictonary of guess paramters for each function
 p0s = {"linear":[-22.5,2028,0.0001,0.0001],
-"quadratic":[2028,0,0.25,0.0001],
+"quadratic":[2028,0.0001,0.25,0.0001], #B isn't 0 as the quadratic guesses in p1s divide by B**2 (like the 0.0001s of the other functions)
 "cubic":[2028,0.0001,0.0001,0.0028],
 "cosine":[2028,1,0.0001,0.0001]}
 
 if args.cfunc=="constant":
 
-    AR_results = fitfunc(ALT,r,p0s[args.rfunc],args.rfunc)
+    AR_results = fitralt(ALT,theta,r,args.rfunc,args.cfunc,p0s[args.rfunc])
 
 else:
     #define new function where the coefficents vary with theta
@@ -137,11 +147,42 @@ else:
     [0.1,1,D,0]
     ]}
 
-    AR_results = opt.curve_fit(newfunc,[ALT,theta],r,p0=p1s[args.cfunc])
+    AR_results = fitralt(ALT,theta,r,args.rfunc,args.cfunc,p1s[args.cfunc])
+    #same model as newfunc, but linear least squares (or an analytic jacobian for cosines) instead of curve_fit
+
+
+## Fitting the optical centre ##
+if args.fixcentre == False:
+
+    def rpred(alt,theta,coeffs):
+        #radial distance from the fit for the altitude (and polar angle)
+        if args.cfunc=="constant":
+            return fdict[args.rfunc](alt,*coeffs)
+        else:
+            return newfunc([alt,theta],*coeffs)
+
+    def residuals(p):
+        #difference between predicted and real pixel positions for the centre p[0:2], theta-az fit p[2:4] and r-alt fit p[4:]
+        THETA = polar_angle(linear(AZ,p[2],p[3],0,0))
+        X, Y = rt2pcoords(rpred(ALT,THETA,p[4:]),THETA,Geometry(p[0:2],args.size))
+        return np.concatenate([X-x,Y-y])
+
+    # the fits above (with the centre fixed) are the starting point, then everything is refined together
+    start = np.concatenate([geo.centre,[ATa,ATb],AR_results[0]])
+    refined = opt.least_squares(residuals,start,x_scale="jac")
+
+    geo = Geometry(refined.x[0:2],args.size)
+    ATa, ATb = refined.x[2], refined.x[3]
+    AR_results = (refined.x[4:], None)
+    print(f"optical centre = ({geo.centre[0]:.1f}, {geo.centre[1]:.1f}), rms residual = {np.sqrt(np.mean(refined.fun**2)):.2f} pixels")
+
+    r, theta = pixels2polars(x,y,geo)
+    tht = pa2az(theta)
+    #polars with the fitted centre, for the plots
 
 
 ## Saving to JSON ##
-jsondict = {"theta-az fit":{"function":"linear","fitted coeffients":[ATa, ATb, ATc, ATd]},"r-alt fit":{"function":args.rfunc,"fitted coeffients":list(AR_results[0])},"device info":{"lat":args.lat,"long":args.long,"elv":args.elv}}
+jsondict = {"theta-az fit":{"function":"linear","fitted coeffients":[float(ATa), float(ATb), ATc, ATd]},"r-alt fit":{"function":args.rfunc,"coefficent function":args.cfunc,"fitted coeffients":[float(c) for c in AR_results[0]]},"device info":{"lat":args.lat,"long":args.long,"elv":args.elv},"geometry":geo.todict()}
 with open(f'out-{args.rfunc}-{args.cfunc}.json', 'w') as fp: #saves setupfile as a json
     json.dump(jsondict, fp,indent=4)
 
@@ -0,0 +1,30 @@
+'''
+Turns a fit from fitting.py into per-pixel lookup tables of the altitude and azimuth for a given image size, and the inverse tables of the pixel position of each altitude and azimuth. The tables are float32 .npy files that can be memory-mapped (np.load(path,mmap_mode="r")), so per-frame tasks (e.g., star overlays, cloud and horizon masks) just index them instead of evaluating the fit for every pixel of every frame.
+
+The tables are cached in a directory and named by the hash of the fit file, so running this again with the same fit and size does nothing, and a new fit makes new tables. From python use lookup_tables() in Pfunctions to get them (making them if needed).
+
+Author: George Hume
+2022
+'''
+
+import argparse
+import time
+from Pfunctions import *
+
+#command line arguments
+parser = argparse.ArgumentParser(description = """
+Makes (or finds in the cache) the per-pixel alt/az and inverse x/y lookup tables of a fit from fitting.py.
+""")
+#adding arguments to praser object
+parser.add_argument('json_path' , type = str, help = 'Path to the JSON file containing the fit paramters and device info.')
+parser.add_argument('--size' , type = int, nargs = 2, help = 'Width and height in pixels of the images the tables are for (size of the reference images by default), e.g., 825 640 for glances.', default = None)
+parser.add_argument('--step' , type = float, help = 'Step in degrees of the alt/az grid of the inverse tables.', default = 0.1)
+parser.add_argument('--cache' , type = str, help = 'Directory the tables are saved in.', default = "lut")
+args = parser.parse_args()
+
+start = time.time()
+tables = lookup_tables(args.json_path,args.size,args.step,args.cache)
+
+for name, table in tables.items():
+    print(f"{name}: {table.shape} {table.dtype} -> {table.filename}")
+print(f"done in {time.time()-start:.1f} s")
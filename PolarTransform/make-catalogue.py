@@ -0,0 +1,70 @@
+'''
+Makes the bright-star catalogue (bright-stars.npz) used by Sfunctions from the Hipparcos catalogue. Only needs running again to change the faintest magnitude or the epoch, the catalogue is included with skyWATCH.
+
+The source can either be the Hipparcos main catalogue (hip_main.dat from CDS, I/239), with the positions moved to the epoch using the proper motions, or the star table of a tetra3/cedar-solve database (default_database.npz, also from hip_main and already at its own epoch).
+
+Stars in the constellation lines (constellationship.fab) are kept even if they are fainter than the faintest magnitude, so the lines can always be drawn.
+
+The catalogue is a compressed .npz with:
+ - stars: structured array of the HIP number, RA (hours, float32), dec (degrees, float32) and V magnitude (float32)
+ - start: index of the first star in each cell of the grid (the stars are sorted into cells)
+ - step: size in degrees of the cells
+ - epoch: year of the positions
+
+Author: George Hume
+2022
+'''
+
+import numpy as np
+import argparse
+from Sfunctions import star_dtype, make_grid, catalogue_path, lines_path, read_lines
+
+#command line arguments
+parser = argparse.ArgumentParser(description = """
+Makes the bright-star catalogue used by Sfunctions from the Hipparcos catalogue.
+""")
+#adding arguments to praser object
+parser.add_argument('source_path' , type = str, help = 'Path to hip_main.dat or a tetra3 default_database.npz.')
+parser.add_argument('--maxmag' , type = float, help = 'Faintest V magnitude kept.', default = 6.0)
+parser.add_argument('--epoch' , type = float, help = 'Year the positions are moved to (only for hip_main.dat).', default = 2024.0)
+parser.add_argument('--step' , type = float, help = 'Size in degrees of the cells of the grid index.', default = 10)
+parser.add_argument('--lines' , type = str, help = 'Constellation lines (in the Stellarium constellationship.fab format) whose stars are always kept.', default = lines_path)
+parser.add_argument('--out' , type = str, help = 'Path to save the catalogue to.', default = catalogue_path)
+args = parser.parse_args()
+
+
+if args.source_path.endswith(".npz"):
+    ## tetra3 star table: ra, dec (radians), x, y, z, magnitude
+    with np.load(args.source_path,allow_pickle=True) as data:
+        table, hip = data["star_table"], data["star_catalog_IDs"]
+        epoch = float(data["props_packed"][()]["epoch_proper_motion"])
+    ra, dec, mag = np.degrees(table[:,0])/15, np.degrees(table[:,1]), table[:,5]
+
+else:
+    ## hip_main.dat: fields are split by |, the ones needed are
+    ## 1 HIP number, 5 V magnitude, 8 RA and 9 dec (degrees, epoch 1991.25), 12 and 13 proper motion in RA*cos(dec) and dec (mas/yr)
+    rows = [line.split("|") for line in open(args.source_path)]
+    rows = [r for r in rows if r[5].strip() and r[8].strip()] #some stars have no magnitude or position
+
+    hip = np.array([int(r[1]) for r in rows])
+    mag = np.array([float(r[5]) for r in rows])
+    ra = np.array([float(r[8]) for r in rows])
+    dec = np.array([float(r[9]) for r in rows])
+    pmra = np.array([float(r[12]) if r[12].strip() else 0 for r in rows])
+    pmdec = np.array([float(r[13]) if r[13].strip() else 0 for r in rows])
+
+    years = args.epoch - 1991.25
+    dec_new = dec + pmdec*years/3.6e6
+    ra = ((ra + pmra*years/3.6e6/np.cos(np.radians(dec))) % 360)/15
+    dec, epoch = dec_new, args.epoch
+
+
+## keep the bright ones and sort them into the grid
+names, pairs = read_lines(args.lines)
+keep = (mag <= args.maxmag) | np.isin(hip,pairs)
+stars = np.zeros(keep.sum(),dtype=star_dtype)
+stars["hip"], stars["ra"], stars["dec"], stars["mag"] = hip[keep], ra[keep], dec[keep], mag[keep]
+
+stars, start = make_grid(stars,args.step)
+np.savez_compressed(args.out,stars=stars,start=start,step=args.step,epoch=epoch)
+print(f"{stars.size} stars brighter than {args.maxmag} (or in the constellation lines) saved to {args.out} (epoch {epoch})")
@@ -0,0 +1,127 @@
+'''
+Automatically plate-solves a night image from the device and uses it to update the fit from fitting.py, so the calibration follows the camera as it drifts without having to make a CSV of stars by hand.
+
+The stars in the image are found (detect_sources in Pfunctions), the bright stars of a catalogue are put on the image with the current fit, and the two are matched. The fit is then updated from the matched stars, starting from the current fit rather than from scratch (refit in Pfunctions), and the matching and updating are repeated with a smaller search radius as the fit gets better.
+
+The bright-star catalogue included with skyWATCH is used (see Sfunctions), or a CSV file with the columns: name, RA in decimal hours, declination in decimal degrees, magnitude (with a header row) can be given instead. The time of the image is taken from its name (images from the capture script are named yyyymmdd_hhmmss_device) unless it is given.
+
+The matched stars can also be added to a CSV file in the same format fitting.py uses, to refit from scratch with all of them later on.
+
+Author: George Hume
+2022
+'''
+
+import numpy as np
+import argparse
+import json
+import re
+import os
+from PIL import Image
+from Pfunctions import *
+from Sfunctions import StarCatalogue
+
+#command line arguments
+parser = argparse.ArgumentParser(description = """
+Finds the stars in a night image, matches them to a catalogue with the current fit and updates the fit with them.
+""")
+#adding arguments to praser object
+parser.add_argument('image_path' , type = str, help = 'Path to the image.')
+parser.add_argument('json_path' , type = str, help = 'Path to the JSON file containing the fit paramters and device info.')
+parser.add_argument('--catalogue' , type = str, help = 'Path to a CSV file of a catalogue (name, RA in hours, dec in degrees, magnitude) to use instead of the bright-star catalogue.', default = None)
+parser.add_argument('--time' , type = str, help = 'UTC time and date the image was taken (yyyy/mm/dd hh:mm:ss), taken from the name of the image by default.', default = None)
+parser.add_argument('--out' , type = str, help = 'Path to save the updated fit to (updates the fit in place by default).', default = None)
+parser.add_argument('--matches' , type = str, help = 'CSV file (in the format used by fitting.py) the matched stars are added to.', default = None)
+parser.add_argument('--maxmag' , type = float, help = 'Faintest magnitude of catalogue stars used.', default = 4.5)
+parser.add_argument('--minalt' , type = float, help = 'Lowest altitude in degrees of catalogue stars used.', default = 10)
+parser.add_argument('--radius' , type = float, help = 'Starting search radius for matching, in pixels of the reference images.', default = 40)
+parser.add_argument('--iterations' , type = int, help = 'Number of times the matching and updating is done.', default = 3)
+parser.add_argument('--memory' , type = float, help = 'How many stars the current fit is worth when updating it.', default = 50)
+parser.add_argument('--minmatches' , type = int, help = 'Fewest matched stars needed to update the fit (e.g., when it is cloudy).', default = 10)
+parser.add_argument('--banner' , type = int, help = 'Rows at the top of the image to ignore (the annotation banner), worked out from the image width by default.', default = None)
+args = parser.parse_args()
+
+
+## time the image was taken
+if args.time == None:
+    stamp = re.search(r"(\d{8})_(\d{6})",os.path.basename(args.image_path))
+    if stamp == None:
+        print("Couldn't get the time from the name of the image, please give it with --time.")
+        exit()
+    d, t = stamp.groups()
+    args.time = f"{d[0:4]}/{d[4:6]}/{d[6:8]} {t[0:2]}:{t[2:4]}:{t[4:6]}"
+
+
+## open the fit, the image and the catalogue
+with open(args.json_path, 'r') as f:
+    prams = json.load(f)
+dinfo = prams["device info"]
+geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+
+img = np.asarray(Image.open(args.image_path).convert("L"))
+height, width = img.shape
+sx, sy = width/geo.size[0], height/geo.size[1] #image can be smaller than the reference images (e.g., a glance)
+
+if args.catalogue != None:
+    try:
+        cat = np.genfromtxt(args.catalogue,delimiter=",",names=["name","ra","dec","mag"],dtype=None,encoding=None,skip_header=1)
+    except:
+        print("Something went wrong unpacking the catalogue. Please check the path is correct and the columns in the file are correct and try again.")
+        exit()
+
+
+## stars in the image, in pixels of the reference images
+if args.banner == None:
+    args.banner = int(1.6*max(width/64,12)) #a bit more than the height of the banner from annotate in Cfunctions
+x, y, flux = detect_sources(img,banner=args.banner)
+x, y = (x+0.5)/sx - 0.5, (y+0.5)/sy - 0.5
+print(f"{x.size} sources found in the image")
+
+
+## bright catalogue stars above the horizon
+if args.catalogue != None:
+    ALT, AZ = radec2azalt(cat["ra"],cat["dec"],np.full(cat.size,args.time),dinfo["lat"],dinfo["long"],dinfo["elv"])
+    keep = (ALT > args.minalt) & (cat["mag"] <= args.maxmag)
+    cat, ALT, AZ = cat[keep], ALT[keep], AZ[keep]
+else:
+    t = str2time([args.time],timescale())[0]
+    stars, ALT, AZ = StarCatalogue().visible(t,dinfo["lat"],dinfo["long"],dinfo["elv"],minalt=args.minalt,maxmag=args.maxmag)
+    #only the cells of the catalogue above the horizon are looked at
+    cat = np.zeros(stars.size,dtype=[("name","U16"),("ra","f8"),("dec","f8"),("mag","f8")])
+    cat["name"] = [f"HIP {h}" for h in stars["hip"]]
+    cat["ra"], cat["dec"], cat["mag"] = stars["ra"], stars["dec"], stars["mag"]
+print(f"{cat.size} catalogue stars above {args.minalt} degrees")
+
+
+## match and update the fit, with a smaller radius each time
+new, radius = prams, args.radius
+for i in range(args.iterations):
+    X, Y = altaz2pixels(ALT,AZ,new) #catalogue stars on the image with the latest fit
+    i1, i2 = match_sources(x,y,X,Y,radius)
+
+    if i1.size < args.minmatches:
+        print(f"Only {i1.size} stars matched (within {radius:.1f} pixels), so the fit is not updated.")
+        exit()
+
+    new, rms = refit(prams,ALT[i2],AZ[i2],x[i1],y[i1],memory=args.memory) #always updates the current fit, so it isn't counted twice
+    print(f"iteration {i+1}: {i1.size} stars matched within {radius:.1f} pixels, rms residual = {rms:.2f} pixels")
+    radius = max(3*rms,2.0)
+
+
+## save the updated fit
+out = args.json_path if args.out == None else args.out
+with open(out+".tmp", 'w') as fp:
+    json.dump(new,fp,indent=4)
+os.replace(out+".tmp",out) #so a half written fit is never read
+print(f"optical centre moved by ({new['geometry']['centre'][0]-geo.centre[0]:.2f}, {new['geometry']['centre'][1]-geo.centre[1]:.2f}) pixels, fit saved to {out}")
+
+
+## add the matched stars to the CSV for fitting.py
+if args.matches != None:
+    ra, dec = dec2sexa(cat["ra"][i2]), dec2sexa(cat["dec"][i2])
+    newfile = not os.path.exists(args.matches)
+    with open(args.matches,'a') as f:
+        if newfile:
+            f.write("name,x,y,RA h,RA m,RA s,dec d,dec m,dec s,time\n")
+        for j in range(i1.size):
+            f.write(f"{cat['name'][i2[j]]},{x[i1[j]]:.2f},{y[i1[j]]:.2f},{ra[j][0]:.0f},{ra[j][1]:.0f},{ra[j][2]:.3f},{dec[j][0]:.0f},{dec[j][1]:.0f},{dec[j][2]:.3f},{args.time}\n")
+    print(f"{i1.size} matched stars added to {args.matches}")
@@ -4,6 +4,7 @@ import argparse
 from Pfunctions import *
 import json
 from PIL import Image
+from Sfunctions import StarCatalogue
 
 #command line arguments
 parser = argparse.ArgumentParser(description = """
@@ -15,6 +16,7 @@ Author: George Hume
 parser.add_argument('test_path' , type = str, help = 'Path to the CSV file containing the test sources.')
 parser.add_argument('json_path' , type = str, help = 'Path to the JSON file containing the fit paramters and device info.')
 parser.add_argument('image_path' , type = str, help = 'Path to the image the test stars are from.')
+parser.add_argument('--catalogue' , type = float, help = 'Also plots where the fit puts the stars of the bright-star catalogue brighter than this magnitude.', default = None)
 args = parser.parse_args()
 
 
@@ -25,10 +27,13 @@ with open(args.json_path, 'r') as f:
 TAinfo = prams["theta-az fit"]
 RAinfo = prams["r-alt fit"]
 dinfo = prams["device info"]
+geo = Geometry.fromdict(prams["geometry"]) if "geometry" in prams else Geometry()
+#optical centre and size of the reference images (older fits used the centre of a full size image)
 
 
 #load in the test stars and the image
 testsky = Image.open(args.image_path)
+geo = geo.resized(testsky.size) #test image can be a different size (e.g., a glance) to the reference images
 realpos = np.loadtxt(args.test_path,delimiter=",",usecols = (1,2),skiprows=1)
 testnames = np.loadtxt(args.test_path,delimiter=",",usecols = 0,dtype=str,skiprows=1)
 testRA = np.loadtxt(args.test_path,delimiter=",",usecols = (3,4,5),skiprows=1)
@@ -64,7 +69,7 @@ else:
 
 
 #calculate the predicted and real xy coords of the test stars
-testX,testY = rt2pcoords(testR,testTHETA)
+testX,testY = rt2pcoords(testR,testTHETA,geo)
 
 
 #delta value
@@ -78,6 +83,13 @@ plt.imshow(testsky)
 plt.scatter(realX,realY,color="r",alpha=0.3)
 plt.scatter(testX,testY,color="b",alpha=0.3)
 
+if args.catalogue != None:
+    #all the bright stars above the horizon at the time of the first test star
+    t = str2time(testTimes[0:1],timescale())[0]
+    stars, catALT, catAZ = StarCatalogue().visible(t,dinfo["lat"],dinfo["long"],dinfo["elv"],maxmag=args.catalogue)
+    catX, catY = altaz2pixels(catALT,catAZ,prams,geo)
+    plt.scatter(catX,catY,s=60,facecolors="none",edgecolors="y",alpha=0.5)
+
 for i in range(testnames.size):
     plt.annotate(testnames[i]+"-real",[realX[i],realY[i]],
                  [realX[i],realY[i]-50],color="r",alpha=0.6)
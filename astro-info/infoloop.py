@@ -1,8 +1,11 @@
 import datetime as dt
-from skyfield.api import N,S,E,W, wgs84, load
 from skyfield import almanac
 import time
 import json
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../Capture"))
+from Efunctions import ephemeris, timescale, observer
 
 #location of roque
 name = "observatory roque de la muchachos"
@@ -10,12 +13,12 @@ roqueN = 28.6468866
 roqueE = -17.7742491
 roqueELV = 2326
 
-eph = load('de421.bsp') #loads ephemerides
-ts = load.timescale() #loads time scale
+eph = ephemeris() #loads ephemerides
+ts = timescale() #loads time scale
 
 #sets up sun and moon plus position on earth
-earth, sun, moon = eph['earth'],eph['sun'],eph['moon']
-ORM = earth + wgs84.latlon(roqueN * N, roqueE * E, elevation_m=roqueELV)
+sun, moon = eph['sun'],eph['moon']
+ORM = observer(roqueN, roqueE, roqueELV)
 
 while True:
     tnow = ts.now() #saves time now
@@ -1,5 +1,5 @@
 import datetime as dt
-from skyfield.api import N,S,E,W, wgs84, load, utc
+from skyfield.api import utc
 from skyfield import almanac
 import time
 import json
@@ -8,6 +8,11 @@ import cv2 as cv
 import numpy as np
 from tqdm import tqdm
 from exif import Image
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../../Capture"))
+from Cfunctions import SnM_batch
+from Efunctions import ephemeris, timescale, observer
 
 #location of roque
 name = "observatory roque de la muchachos"
@@ -15,16 +20,19 @@ roqueN = 28.6468866
 roqueE = -17.7742491
 roqueELV = 2326
 
-eph = load('de421.bsp') #loads ephemerides
-ts = load.timescale() #loads time scale
+eph = ephemeris() #loads ephemerides
+ts = timescale() #loads time scale
 
-#sets up sun and moon plus position on earth
-earth, sun, moon = eph['earth'],eph['sun'],eph['moon']
-ORM = earth + wgs84.latlon(roqueN * N, roqueE * E, elevation_m=roqueELV)
+#sets up position on earth
+ORM = observer(roqueN, roqueE, roqueELV)
 
 imgs = glob.glob("/media/george/Work/skyWATCH/20220407/*.jpg")
 temps = glob.glob('dome-templates/hf**.jpg') #loads in templates
 
+dates = [] #time each image was taken
+domes = [] #dome status of each image
+metas = [] #exif info of each image
+
 for i in imgs:
 
     #read image metadata
@@ -33,32 +41,7 @@ for i in imgs:
 
     date = dt.datetime.strptime(image['datetime'], '%Y:%m:%d %H:%M:%S') #converts date into datetime object
     date=date.replace(tzinfo=utc) #adds utc time zone to datetime object - may need to chnage this
-    tnow = ts.from_datetime(date) #saves time as skyfield time object
-
-    tnowdt = tnow.utc_datetime().strftime("%Y-%m-%d %H:%M:%S") #string version
-    astro = ORM.at(tnow).observe(sun)
-    app = astro.apparent()
-    alt, az, distance = app.altaz()
-
-    #calculate the time of day
-    if alt.degrees > 0:
-        mode = "day time"
-    elif (0>alt.degrees>-6):
-        mode = "civil twilight"
-    elif (-6>alt.degrees>-12):
-        mode = "nautical twilight"
-    elif (-12>alt.degrees>-18):
-        mode = "astronomical twilight"
-    else:
-        mode = "dark time"
-
-    #calculate moon's alt, phase, and illumination
-    mastro = ORM.at(tnow).observe(moon)
-    mapp = mastro.apparent()
-    malt, maz, mdst = mapp.altaz()
-    mphase = almanac.moon_phase(eph, tnow).degrees
-    mill = almanac.fraction_illuminated(eph,"moon",tnow)
-
+    dates.append(date)
 
     ## DETECT IF DOME IS OPEN OR CLOSED ##
     # NEW METHOD #
@@ -103,14 +86,26 @@ for i in imgs:
         result = "Open"
 
 
+    domes.append(result)
+    metas.append({"name":i[-26:],"exposure time":image["exposure_time"], "width":image["image_width"], "height":image["image_height"]})
+
+
+## SUN AND MOON INFO FOR ALL THE IMAGES IN ONE GO ##
+tall = ts.from_datetimes(dates) #skyfield time object holding the times of all the images
+props = SnM_batch(ORM,tall,eph)
+
+for k in range(len(imgs)):
+    tnow = tall[k]
+    tnowdt = tnow.utc_datetime().strftime("%Y-%m-%d %H:%M:%S") #string version
+
     #construct dict of these values to be turned into JSON
     values = {"time":tnowdt,
     "location":{"name":name,"latitude":roqueN,"longitude":roqueE,"elevation":roqueELV},
-              "period of the day":mode,
-              "sun":{"altitude":round(alt.degrees,7)},
-              "moon":{"altitude":round(malt.degrees,7),"phase":round(mphase,7),"illumination":round(mill,7)},
-              "dome-status": result,
-              "image":{"name":i[-26:],"exposure time":image["exposure_time"], "width":image["image_width"], "height":image["image_height"]}
+              "period of the day":str(props["period"][k]),
+              "sun":{"altitude":round(props["sun_alt"][k],7)},
+              "moon":{"altitude":round(props["moon_alt"][k],7),"phase":round(props["moon_phase"][k],7),"illumination":round(props["moon_ill"][k],7)},
+              "dome-status": domes[k],
+              "image":metas[k]
              }
 
     #saves json
@@ -0,0 +1,189 @@
+"""
+Wfunctions: cached warp maps for the geometric correction of all-sky images, for use in:
+ - warp.py
+ - geo-correct/geo-correct.py
+ - distortion/cam_calib.py
+
+A warp (the homography from geo-correct.py or the undistortion from a camera calibration) is turned into a pair of maps, saying which pixel of the input image each pixel of the output comes from, the first time it is needed. The maps are kept in OpenCV's fixed-point format (int16 x,y plus a uint16 index of the sub-pixel weights) and saved to disk, named by a hash of the warp, so the same calibration reuses them (e.g., for every image of a night) and each image is warped with a single cv.remap, instead of working out the warp again for every pixel of every image.
+
+The homography itself is fitted from matched star positions with fit_homography, robustly (RANSAC, LMedS or RHO) so a few wrong matches don't pull the fit off, then refitted by least squares on the stars that agree with it.
+
+Usage:
+    M, inliers, residuals = fit_homography(pts_skymap,pts_allsky)
+    warp = WarpMap.homography(M,(6000,6000))
+    out = warp.apply(img)
+
+Author: George Hume
+2022
+"""
+
+### IMPORTS ###
+import cv2 as cv
+import numpy as np
+import hashlib
+import os
+
+##############################################################################################################
+
+methods = {"lsq":0,"ransac":cv.RANSAC,"lmeds":cv.LMEDS,"rho":cv.RHO} #ways findHomography can fit
+
+def homography_residuals(M,src,dst):
+    ### distance in pixels between dst and src put through the homography M, for (N, 2) arrays of points
+    proj = cv.perspectiveTransform(np.asarray(src,dtype=np.float64).reshape(-1,1,2),np.asarray(M,dtype=np.float64)).reshape(-1,2)
+    return np.hypot(*(proj - np.asarray(dst,dtype=np.float64).reshape(-1,2)).T)
+
+def fit_homography(src,dst,method="ransac",threshold=5.0,clip=3.0,maxiter=10):
+    ### homography mapping the (N, 2) points src onto dst, robust to wrong matches
+    ## method is a key of methods, threshold is the largest residual (pixels) of a good match for RANSAC and RHO
+    ## after the robust fit it is refitted by least squares on the good matches, dropping any more than clip times the robust spread of the residuals (1.4826 x median) from it until none are left
+    ## returns M, a mask of the matches used and the residuals of all the matches
+    src, dst = np.float32(src).reshape(-1,1,2), np.float32(dst).reshape(-1,1,2)
+    if src.shape[0] < 4:
+        raise ValueError(f"need at least 4 matches to fit a homography, got {src.shape[0]}")
+
+    M, mask = cv.findHomography(src,dst,methods[method],threshold)
+    if M is None:
+        raise ValueError("findHomography failed, check the matches")
+    if method == "lsq":
+        return M, np.ones(src.shape[0],dtype=bool), homography_residuals(M,src,dst)
+
+    inliers = mask.ravel() == 1
+    if inliers.sum() < 4:
+        #e.g., LMedS when the model fits badly, so start from the spread of the residuals instead
+        res = homography_residuals(M,src,dst)
+        inliers = res <= clip*1.4826*np.median(res)
+
+    for i in range(maxiter):
+        if inliers.sum() < 4:
+            break
+        M = cv.findHomography(src[inliers],dst[inliers],0)[0]
+        res = homography_residuals(M,src,dst)
+        sigma = 1.4826*np.median(res[inliers])
+        keep = inliers & (res <= max(clip*sigma,1e-6))
+        if (keep == inliers).all() or keep.sum() < 4:
+            break
+        inliers = keep
+
+    return M, inliers, homography_residuals(M,src,dst)
+
+##############################################################################################################
+
+class WarpMap:
+    '''
+    FIXED-POINT REMAP TABLES OF A WARP, CACHED ON DISK
+
+    Arguments:
+        - map1: (height, width, 2) int16 x,y of the input pixel for each output pixel
+        - map2: (height, width) uint16 sub-pixel interpolation index
+        - roi: (x, y, width, height) of the valid part of the output (all of it if None)
+
+    Made with:
+        - WarpMap.homography(M,size): same as cv.warpPerspective(img,M,size)
+        - WarpMap.undistort(mtx,dist,size): same as cv.undistort with the new camera matrix from cv.getOptimalNewCameraMatrix
+        - first.then(second): one warp doing both (e.g., undistort then the homography), so an image only needs one pass
+
+    Process:
+        cv.remap with fixed-point maps only has to read the tables and the input, so warping a frame is a single pass over memory. The tables are saved as .npy files in the cache directory and memory-mapped when read back, with names from a hash of the warp and the sizes.
+    '''
+
+    def __init__(self,map1,map2,roi=None,key=None):
+        self.key = key #name in the cache
+        self.map1 = map1
+        self.map2 = map2
+        self.size = (map1.shape[1],map1.shape[0])
+        self.roi = (0,0,self.size[0],self.size[1]) if roi == None else tuple(int(i) for i in roi)
+
+    @staticmethod
+    def _key(kind,arrays,size):
+        ### name of a warp in the cache, from what kind it is, its parameters and the output size
+        h = hashlib.sha1(kind.encode())
+        for a in arrays:
+            h.update(np.ascontiguousarray(a,dtype=np.float64).tobytes())
+        h.update(np.array(size,dtype=np.int64).tobytes())
+        return f"{kind}-{h.hexdigest()[:16]}"
+
+    @staticmethod
+    def _load(cache,key):
+        ### maps from the cache (None if they aren't there)
+        names = [os.path.join(cache,f"{key}-map{i}.npy") for i in (1,2)]
+        if cache == None or not all(os.path.exists(n) for n in names):
+            return None
+        return [np.load(n,mmap_mode="r") for n in names]
+
+    @staticmethod
+    def _save(cache,key,map1,map2):
+        ### saves maps to the cache, via temporary files so a half written map is never read
+        if cache == None:
+            return
+        os.makedirs(cache,exist_ok=True)
+        for i, m in ((1,map1),(2,map2)):
+            name = os.path.join(cache,f"{key}-map{i}.npy")
+            with open(f"{name}.{os.getpid()}.tmp","wb") as f:
+                np.save(f,m)
+            os.replace(f"{name}.{os.getpid()}.tmp",name)
+
+    @classmethod
+    def homography(cls,M,size,cache="warp-cache",chunk=512):
+        ### warp of the 3x3 homography M (input to output pixels) onto an output image of size (width, height)
+        key = cls._key("homography",[M],size)
+        maps = cls._load(cache,key)
+
+        if maps == None:
+            width, height = size
+            Minv = np.linalg.inv(np.asarray(M,dtype=np.float64)) #output pixel to input pixel, as warpPerspective does
+            map1 = np.empty((height,width,2),dtype=np.int16)
+            map2 = np.empty((height,width),dtype=np.uint16)
+            xs = np.arange(width,dtype=np.float64)
+
+            for row in range(0,height,chunk):
+                #a chunk of rows at a time, so the float maps of a big output don't all need to be in memory
+                y, x = np.meshgrid(np.arange(row,min(row+chunk,height),dtype=np.float64),xs,indexing="ij")
+                w = Minv[2,0]*x + Minv[2,1]*y + Minv[2,2]
+                mx = ((Minv[0,0]*x + Minv[0,1]*y + Minv[0,2])/w).astype(np.float32)
+                my = ((Minv[1,0]*x + Minv[1,1]*y + Minv[1,2])/w).astype(np.float32)
+                map1[row:row+chunk], map2[row:row+chunk] = cv.convertMaps(mx,my,cv.CV_16SC2)
+
+            cls._save(cache,key,map1,map2)
+            maps = [map1,map2]
+
+        return cls(*maps,key=key)
+
+    @classmethod
+    def undistort(cls,mtx,dist,size,alpha=1,cache="warp-cache"):
+        ### undistortion of a camera with matrix mtx and distortion coefficents dist (from cv.calibrateCamera) for images of size (width, height)
+        ## alpha is the free scaling of cv.getOptimalNewCameraMatrix (1 keeps every input pixel, 0 only valid output pixels)
+        newmtx, roi = cv.getOptimalNewCameraMatrix(mtx,dist,size,alpha,size)
+        key = cls._key("undistort",[mtx,dist,[alpha]],size)
+        maps = cls._load(cache,key)
+
+        if maps == None:
+            maps = cv.initUndistortRectifyMap(mtx,dist,None,newmtx,size,cv.CV_16SC2)
+            cls._save(cache,key,*maps)
+
+        return cls(*maps,roi=roi,key=key)
+
+    def then(self,other,cache="warp-cache"):
+        ### one warp doing this warp and then other (the output of this warp is the input of other)
+        key = self._key("chain",[np.frombuffer(f"{self.key}{other.key}".encode(),dtype=np.uint8)],other.size)
+        maps = self._load(cache,key)
+
+        if maps == None:
+            ax, ay = cv.convertMaps(self.map1,self.map2,cv.CV_32FC1) #where each pixel of this warp's output comes from
+            bx, by = cv.convertMaps(other.map1,other.map2,cv.CV_32FC1)
+            #looks up this warp's map at the points other's map comes from, off the edge is well outside the image
+            cx = cv.remap(ax,bx,by,cv.INTER_LINEAR,borderMode=cv.BORDER_CONSTANT,borderValue=-30000)
+            cy = cv.remap(ay,bx,by,cv.INTER_LINEAR,borderMode=cv.BORDER_CONSTANT,borderValue=-30000)
+            maps = cv.convertMaps(cx,cy,cv.CV_16SC2)
+            self._save(cache,key,*maps)
+
+        return WarpMap(*maps,roi=other.roi,key=key)
+
+    def apply(self,img,interpolation=cv.INTER_LINEAR,crop=False):
+        ### warps img, crop=True cuts the output down to the valid region (roi)
+        out = cv.remap(img,self.map1,self.map2,interpolation,borderMode=cv.BORDER_CONSTANT)
+        if crop:
+            x, y, w, h = self.roi
+            out = out[y:y+h,x:x+w]
+        return out
+
+##############################################################################################################
@@ -2,6 +2,10 @@ import numpy as np
 import cv2 as cv
 import glob
 import argparse
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Wfunctions import WarpMap
 
 #sys arguments
 parser = argparse.ArgumentParser(description = "Calibrates the camera from images taken of checkerboard. Calibration images should end in .PNG, test image to be undistorted should be called 'test.png'.")
@@ -49,14 +53,9 @@ ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, grey.sha
 #load in test image
 img = cv.imread(f'{args.dir}/test.png')
 h,  w = img.shape[:2]
-newcameramtx, roi = cv.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
 
-#undistort
-dst = cv.undistort(img, mtx, dist, None, newcameramtx)
-
-# crop the image
-x, y, w, h = roi
-dst = dst[y:y+h, x:x+w]
+#undistort (and crop the image), the maps are cached so warp.py can reuse them
+dst = WarpMap.undistort(mtx, dist, (w,h)).apply(img, crop=True)
 cv.imwrite(f'{args.dir}/test_UD.png', dst)
 
 #save parameters
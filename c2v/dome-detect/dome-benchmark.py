@@ -0,0 +1,220 @@
+'''
+Benchmarks the dome detection functions in Capture/Cfunctions.py on glances that are already known to be of the dome open or closed, so changes to the detection can be judged on both how often it is right and how long it takes.
+
+The glances are read from a directory with an open and a closed directory in it:
+    labelled/
+        open/*.jpg
+        closed/*.jpg
+
+Each detector is run on every glance (repeat times, for the timing), and for each detector it reports:
+ - precision and recall of it saying the dome is closed (and the number of glances right and wrong each way)
+ - percentiles of the time taken for each glance (including reading it in, as in the capture script)
+ - peak memory allocated during a detection (with --memory, measured on a separate run so it doesn't slow down the timing)
+The largest memory used by any of the processes (max RSS) is also reported.
+
+By default every glance is judged on its own, starting from the initial limits and the dome being closed, so the results don't depend on the order or how they are split between the processes. With --sequence the glances are gone through in order of their names with the detectors keeping their state (limits, and if the dome was closed) between them, as they would during a night (one process per detector).
+
+To add a detector, add it to detectors below.
+
+Author: George Hume
+2022
+'''
+
+### IMPORTS ###
+import numpy as np
+import argparse
+import copy
+import glob
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../../Capture"))
+from Cfunctions import dome_detect, dome_detect2, DomeDetector
+
+#limits used by the capture scripts, for 825x640 glances
+config = {
+    "templims": [[[122,172],[520,570]],[[107,157],[28,78]]], #dome_detect (v0.5 to v0.7): x limits of both templates then y limits of both
+    "l1": [[104,204],[75,175]], #dome_detect2 and DomeDetector (v0.8): limits of template 1
+    "l2": [[505,506],[6,106]], #limits of template 2
+    "maxL": [[[25,325],[25,225]],[[450,735],[0,200]]], #max limits of template 1 and 2
+}
+
+##############################################################################################################
+
+def detectors(templates,cfg):
+    ### the detectors benchmarked, each is a (detect, reset) pair
+    ## detect(path,domestatus) returns the new domestatus for the glance at path, reset() puts its state back to the start of a night
+
+    state = {}
+
+    def reset2():
+        state["l1"], state["l2"] = copy.deepcopy(cfg["l1"]), copy.deepcopy(cfg["l2"])
+    def detect2(path,domestatus):
+        domestatus, state["l1"], state["l2"] = dome_detect2(path,templates,state["l1"],state["l2"],cfg["maxL"],domestatus)
+        return domestatus
+
+    limits = DomeDetector(templates,copy.deepcopy(cfg["l1"]),copy.deepcopy(cfg["l2"]),cfg["maxL"])
+    ncc = DomeDetector(templates,copy.deepcopy(cfg["l1"]),copy.deepcopy(cfg["l2"]),cfg["maxL"],mode="ncc")
+    if "calib" in cfg:
+        ncc.calib = [tuple(c) for c in cfg["calib"]]
+
+    def resetter(dome):
+        def reset():
+            dome.lims = copy.deepcopy([cfg["l1"],cfg["l2"]])
+        return reset
+
+    return {
+        "dome_detect": (lambda path, domestatus: dome_detect(path,templates,cfg["templims"]), lambda: None),
+        "dome_detect2": (detect2, reset2),
+        "DomeDetector": (limits.detect, resetter(limits)),
+        "DomeDetector-ncc": (ncc.detect, resetter(ncc)),
+    }
+
+##############################################################################################################
+
+def init(templates,cfg):
+    ### sets up the detectors in a process, so the templates are only loaded once in each
+    global DETECTORS
+    DETECTORS = detectors(templates,cfg)
+
+##############################################################################################################
+
+def work(name,items,sequence=False,repeat=1,memory=False):
+    ### runs detector name on items, a list of (path, closed), returns a row for each glance and the max RSS of the process (MB)
+    ## rows are (path, closed, predicted closed, times in seconds, peak memory allocated in MB or nan)
+    detect, reset = DETECTORS[name]
+    rows = []
+    domestatus = True
+    reset()
+
+    for path, closed in items:
+        times = []
+        if sequence == True:
+            #state carries on from the previous glance, so it can only be run once
+            st = time.perf_counter()
+            domestatus = detect(path,domestatus)
+            times.append(time.perf_counter()-st)
+        else:
+            for i in range(repeat):
+                reset() #every glance judged from the start of a night
+                st = time.perf_counter()
+                domestatus = detect(path,True)
+                times.append(time.perf_counter()-st)
+        rows.append([path,closed,bool(domestatus),times,np.nan])
+
+    if memory == True:
+        #separate run, as tracing the memory slows it down
+        for row in rows:
+            reset()
+            tracemalloc.start()
+            detect(row[0],True)
+            row[4] = tracemalloc.get_traced_memory()[1]/1e6
+            tracemalloc.stop()
+
+    return [tuple(r) for r in rows], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+##############################################################################################################
+
+def summary(rows):
+    ### precision, recall and latency percentiles of the rows from work
+    closed = np.array([r[1] for r in rows])
+    pred = np.array([r[2] for r in rows])
+    times = np.concatenate([r[3] for r in rows])*1e3
+    peaks = np.array([r[4] for r in rows])
+
+    tp, fp = np.sum(pred & closed), np.sum(pred & ~closed)
+    fn, tn = np.sum(~pred & closed), np.sum(~pred & ~closed)
+    precision = tp/(tp+fp) if (tp+fp) > 0 else np.nan
+    recall = tp/(tp+fn) if (tp+fn) > 0 else np.nan
+    p50, p90, p99 = np.percentile(times,[50,90,99])
+
+    return {"n":closed.size,"TP":int(tp),"FP":int(fp),"FN":int(fn),"TN":int(tn),"precision":precision,"recall":recall,"accuracy":(tp+tn)/closed.size,
+            "p50":p50,"p90":p90,"p99":p99,"max":times.max(),"peak":np.nanmax(peaks) if np.isfinite(peaks).any() else np.nan}
+
+##############################################################################################################
+
+if __name__ == "__main__":
+    #command line arguments
+    parser = argparse.ArgumentParser(description = """
+    Benchmarks the dome detection functions on glances in the open and closed directories of a directory, reporting precision and recall of detecting the dome closed, the time taken per glance and the memory used.
+    Author: George Hume
+    2022
+    """)
+    #adding arguments to praser object
+    parser.add_argument('labelled_dir' , type = str, help = 'Path to the directory with the open and closed directories of glances in it.')
+    parser.add_argument('--templates' , type = str, nargs = 2, help = 'Paths to the 2 templates.', default = [os.path.join(os.path.dirname(os.path.abspath(__file__)),f"../../Capture/dome-templates/hflr-template{i}.jpg") for i in (1,2)])
+    parser.add_argument('--detectors' , type = str, nargs = '+', help = 'Detectors to benchmark (all of them by default).', default = None)
+    parser.add_argument('--config' , type = str, help = 'JSON file of limits to use instead of the ones in the capture scripts (any of: templims, l1, l2, maxL, and calib for the ncc mode).', default = None)
+    parser.add_argument('--repeat' , type = int, help = 'Number of times each glance is timed (only once with --sequence).', default = 3)
+    parser.add_argument('--workers' , type = int, help = 'Number of processes used (use 1 for the most reliable timings).', default = os.cpu_count())
+    parser.add_argument('--sequence' , action = 'store_true', help = 'Go through the glances in order keeping the state of the detectors between them, as during a night.')
+    parser.add_argument('--memory' , action = 'store_true', help = 'Also measure the peak memory allocated during each detection.')
+    parser.add_argument('--csv' , type = str, help = 'Path to save the result for each glance and detector to.', default = None)
+    args = parser.parse_args()
+
+    cfg = dict(config)
+    if args.config != None:
+        with open(args.config) as f:
+            cfg.update(json.load(f))
+
+    #glances and if the dome is closed in them
+    items = []
+    for label in ("open","closed"):
+        for ext in ("jpg","jpeg","png","bmp"):
+            items += [(p,label == "closed") for p in glob.glob(os.path.join(args.labelled_dir,label,f"*.{ext}"))]
+    items.sort(key=lambda i: os.path.basename(i[0]))
+    if len(items) == 0:
+        print(f"ERROR: no glances found in {args.labelled_dir}/open or {args.labelled_dir}/closed")
+        exit()
+    print(f"{len(items)} glances ({sum(c for p,c in items)} closed, {sum(not c for p,c in items)} open)")
+
+    available = list(detectors(args.templates,cfg)) #also checks the templates can be read
+    names = available if args.detectors == None else args.detectors
+    for name in names:
+        if name not in available:
+            print(f"ERROR: no detector called {name}, choose from: {', '.join(available)}")
+            exit()
+
+    #splits the work into tasks, a detector with state needs all the glances in one task
+    if args.sequence == True:
+        tasks = [(name,items) for name in names]
+    else:
+        size = max(len(items)//(4*args.workers),1)
+        tasks = [(name,items[i:i+size]) for name in names for i in range(0,len(items),size)]
+
+    results = {name:[] for name in names}
+    rss = 0
+    st = time.time()
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers,initializer=init,initargs=(args.templates,cfg)) as pool:
+            futures = [(name,pool.submit(work,name,part,args.sequence,args.repeat,args.memory)) for name, part in tasks]
+            for name, future in futures:
+                rows, r = future.result()
+                results[name] += rows
+                rss = max(rss,r)
+    else:
+        init(args.templates,cfg)
+        for name, part in tasks:
+            rows, r = work(name,part,args.sequence,args.repeat,args.memory)
+            results[name] += rows
+            rss = max(rss,r)
+    print(f"done in {time.time()-st:.1f} s with {args.workers} process(es)\n")
+
+    #table of the results
+    print(f"{'detector':<18}{'TP':>5}{'FP':>5}{'FN':>5}{'TN':>5}{'precision':>11}{'recall':>8}{'accuracy':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'peak MB':>9}")
+    for name in names:
+        s = summary(results[name])
+        print(f"{name:<18}{s['TP']:>5}{s['FP']:>5}{s['FN']:>5}{s['TN']:>5}{s['precision']:>11.3f}{s['recall']:>8.3f}{s['accuracy']:>10.3f}{s['p50']:>9.2f}{s['p90']:>9.2f}{s['p99']:>9.2f}{s['max']:>9.2f}{s['peak']:>9.2f}")
+    print(f"\nlargest memory used by a process (max RSS): {rss:.0f} MB")
+
+    if args.csv != None:
+        with open(args.csv,'w') as f:
+            f.write("detector,path,closed,predicted closed,median time ms,peak MB\n")
+            for name in names:
+                for path, closed, pred, times, peak in results[name]:
+                    f.write(f"{name},{path},{int(closed)},{int(pred)},{np.median(times)*1e3:.3f},{peak:.3f}\n")
+        print(f"results for each glance saved to {args.csv}")
@@ -3,6 +3,9 @@ import cv2 as cv
 import numpy as np
 import argparse
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Wfunctions import WarpMap, fit_homography, methods
 
 #command line arguments
 parser = argparse.ArgumentParser(description = """
@@ -13,26 +16,46 @@ Author: George Hume
 #adding arguments to praser object
 parser.add_argument('coords' , type = str, help = 'Path to the CSV file containing the coordinates of corresponding stars in the all-sky image and sky-map.')
 parser.add_argument('--SMimage' , type = str, help = 'Path to the sky-map image file, if you want transformation to be applied to it at the end. By default this this will not occur.', default = "None")
+parser.add_argument('--method' , type = str, choices = list(methods), help = 'How the matrix is fitted: ransac (default), lmeds or rho ignore wrong matches, lsq uses all of them.', default = "ransac")
+parser.add_argument('--threshold' , type = float, help = 'Largest distance (pixels on the all-sky image) of a good match, for ransac and rho.', default = 5.0)
+parser.add_argument('--clip' , type = float, help = 'Matches further than this many times the spread of the residuals from the refit are dropped.', default = 3.0)
+parser.add_argument('--residuals' , type = str, help = 'Path to save a CSV of the residual of each star (and if it was used) to.', default = None)
 args = parser.parse_args()
 
 #load in a csv file with x,y points from all-sky image and x',y' points from the skymap for target stars
-coords=np.loadtxt(args.coords,delimiter=",",dtype="int",skiprows=1)
-x,y = coords.T[1], coords.T[2] #x and y for sky-map are in 2nd and 3rd columns
-x1, y1 = coords.T[3], coords.T[4] #x and y for all-sky image are in 4th and 5th columns
+coords=np.genfromtxt(args.coords,delimiter=",",skip_header=1,usecols=(1,2,3,4),ndmin=2) #sub-pixel positions (e.g., from detected stars) are fine
+names=np.genfromtxt(args.coords,delimiter=",",skip_header=1,usecols=0,dtype=str,ndmin=1)
+x,y = coords.T[0], coords.T[1] #x and y for sky-map are in 2nd and 3rd columns
+x1, y1 = coords.T[2], coords.T[3] #x and y for all-sky image are in 4th and 5th columns
 
-#remove targets which don't appear on all-sky image (marked with zeros, make sure no targets have coordinates of zero!)
-unmatch = x1!=0 #mask
+#remove targets which don't appear on all-sky image (marked with zeros or left empty)
+unmatch = np.isfinite(coords).all(axis=1) & ((x1!=0) | (y1!=0)) #mask
 #apply mask to x,y,x',y'
+names = names[unmatch]
 x = x[unmatch]
 y = y[unmatch]
 x1 = x1[unmatch]
 y1 = y1[unmatch]
 
-#do polynomial least fit to find warping coefficents of the X and Y transformation matrices
-#perspective transformation
+#perspective transformation, fitted robustly so wrong matches are found and left out
 pts1 = np.float32(np.vstack((x,y)).T.reshape(-1,1,2))
 pts2 = np.float32(np.vstack((x1,y1)).T.reshape(-1,1,2))
-M,mask = cv.findHomography(pts1,pts2) #matrix will map sky-map onto all-sky
+try:
+    M,inliers,res = fit_homography(pts1,pts2,args.method,args.threshold,args.clip) #matrix will map sky-map onto all-sky
+except ValueError as e:
+    print(f"ERROR: {e}")
+    exit()
+
+print(f"{inliers.sum()} of {inliers.size} matches used, rms residual = {np.sqrt(np.mean(res[inliers]**2)):.2f} pixels")
+for i in np.flatnonzero(~inliers):
+    print(f"  dropped {names[i]}: residual {res[i]:.1f} pixels")
+
+if args.residuals != None:
+    with open(args.residuals,'w') as f:
+        f.write("Star,x,y,x’,y’,residual,used\n")
+        for i in range(names.size):
+            f.write(f"{names[i]},{x[i]:g},{y[i]:g},{x1[i]:g},{y1[i]:g},{res[i]:.3f},{int(inliers[i])}\n")
+    print(f"residuals saved to {args.residuals}")
 
 #need to save the transformation matrix so it can be used again.
 np.save('transfrom-mat',M)
@@ -41,7 +64,7 @@ np.save('transfrom-mat',M)
 #option to apply transformation matrix on each point of the all-sky image to correct it
 if args.SMimage != "None":
     smim = cv.imread(args.SMimage)
-    dst =  cv.warpPerspective(smim, M, (6000, 6000))
+    dst =  WarpMap.homography(M, (6000, 6000)).apply(smim) #maps are cached, so warp.py can reuse them for other images
     cv.imwrite(f'{args.SMimage[0:-4]}_dst.png',dst)
 else:
     exit()
@@ -1,19 +1,24 @@
 #imports
 import cv2 as cv
 import numpy as np
-import imgkit
 import argparse
 import json
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../../PolarTransform"))
+from Pfunctions import timescale, str2time, polar_fit
+from Sfunctions import Overlay
 
 #command line arguments
 parser = argparse.ArgumentParser(description = """
 Creates sky map at the same position and time as an all-sky image with the same dimensions, which will be used for geometric correction of the all-sky image.
+The map is drawn offline from the bright-star catalogue in PolarTransform (polar projection with north at the top and east on the left, as virtualsky's).
 Author: George Hume
 2022
 """)
 #adding arguments to praser object
 parser.add_argument('path' , type = str, help = 'Path to the JSON information file for the all-sky image file.')
+parser.add_argument('--maxmag' , type = float, help = 'Faintest stars drawn.', default = 6.0)
 parser.add_argument('--ext' , type = str, help = 'Image file type the outputs will be saved as. Supports PNG (default), JPEG and BMP.', default = "png")
 args = parser.parse_args()
 
@@ -29,36 +34,19 @@ w = skyinfo["width"]
 lat = str(skyinfo["location"]["latitude"])
 long = str(skyinfo["location"]["longitude"])
 
-#time needs to be formatted just right otherwise you get a blank screen
-date = skyinfo["date"]
-#extracts each component of the date from the date string
-dd = date[8:10] #day
-mm = date[5:7] #month
-yyyy = date[0:4] #year
-HH = date[11:13] #hour
-MM = date[14:16] #mins
-SS = date[17:19] #secs
-#need to convert the month into its 2 letter nanme
-months = {"01":"Jan","02":"Feb","03":"Mar","04":"Apr","05":"May","06":"Jun","07":"Jul","08":"Aug","09":"Sep","10":"Oct","11":"Nov","12":"Dec"} #dict of months
-mmm = months[mm]
-clock = f"%20{mmm}%20{dd}%20{yyyy}%20{HH}:{MM}:{SS}%20UTC"
+#time the all-sky image was taken
+t = str2time([skyinfo["date"].replace("-","/")],timescale())[0]
 
-#creates the map from html
-html_map = f'<iframe width="1000" height="1000" frameborder="0" scrolling="no" marginheight="0" marginwidth="0" src="https://virtualsky.lco.global/embed/index.html?longitude={long}&latitude={lat}&gradient=false&projection=polar&mouse=false&keyboard=false&cardinalpoints=false&showplanetlabels=false&showdate=false&showposition=false&clock={clock}" allowTransparency="true"></iframe>'
-map_name = f'map_{yyyy}{mm}{dd}{HH}{MM}{SS}'
-with open(f'{map_name}.html', 'w') as file:
-    file.write(html_map) #saves string as html file
-
-#turns html file into image
-imgkit.from_file(f'{map_name}.html', f'{map_name}.{args.ext}')
+#draws the stars (like virtualsky's polar projection) on a black image the same width as the sky image
+elv = skyinfo["location"].get("elevation",0)
+overlay = Overlay(polar_fit(w,w,float(lat),float(long),elv),maxmag=args.maxmag)
+map = overlay.draw(np.zeros((w,w,3),dtype=np.uint8),t,lines=False,labels=False)
+map_name = f'map_{skyinfo["date"][0:4]}{skyinfo["date"][5:7]}{skyinfo["date"][8:10]}{skyinfo["date"][11:13]}{skyinfo["date"][14:16]}{skyinfo["date"][17:19]}'
 
 
 #editing the skymap image to be the same size as the all-sky image
-map = cv.imread(f'{map_name}.{args.ext}') #imports image using openCV
-map = map[8:1008,8:1008] #crop image so no boarders
-map = cv.resize(map, [w,w]) #resize map to be same width as sky image
 lower = int((w-h)/2) #indices so crop is at centre of image
-map =  map[lower:lower+h] #crop the distored map so it has same dimensions as sky
+map =  map[lower:lower+h] #crop the map so it has same dimensions as sky
 
-#saves the final map (overwrites the original prodcued)
+#saves the final map
 cv.imwrite(f'{map_name}.{args.ext}',map)
@@ -0,0 +1,126 @@
+"""
+Applies the geometric correction to all-sky images: the undistortion from a camera calibration (distortion/cam_calib.py), the homography from geo-correct/geo-correct.py, or both, using the cached warp maps in Wfunctions.
+The maps are only worked out the first time a calibration is used (then read from the cache), and both corrections are combined into one map, so each image is warped with a single cv.remap.
+
+A whole night can be done at once by giving the images.list file the capture script writes (placeholders for when the dome was closed are skipped). The images are split between a pool of processes, each reading, warping and saving one image at a time, and they all memory-map the same cached maps, so the memory used doesn't grow with the number of images.
+Author: George Hume
+2022
+"""
+
+### IMPORTS ###
+import cv2 as cv
+import numpy as np
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Wfunctions import WarpMap
+
+##############################################################################################################
+
+def make_warp(size,settings):
+    ### warp for images of size (width, height) from the calibration and/or homography in settings
+    warp = None
+    if settings["calibration"] != None:
+        c_pars = np.load(settings["calibration"])
+        warp = WarpMap.undistort(c_pars['arr_1'],c_pars['arr_2'],size,cache=settings["cache"])
+    if settings["homography"] != None:
+        hwarp = WarpMap.homography(np.load(settings["homography"]),tuple(settings["size"]),cache=settings["cache"])
+        warp = hwarp if warp == None else warp.then(hwarp,cache=settings["cache"])
+    return warp
+
+##############################################################################################################
+
+def init(settings,threads=None):
+    ### sets up a process to warp images (the settings and the warps it has loaded)
+    global SETTINGS, WARPS
+    SETTINGS, WARPS = settings, {}
+    if threads != None:
+        cv.setNumThreads(threads) #the pool already uses all the cores, so each process sticks to one
+
+##############################################################################################################
+
+def work(path):
+    ### warps and saves one image, returns a line for the log
+    img = cv.imread(path)
+    if img is None:
+        return f"ERROR: couldn't read {path}, skipping it"
+
+    size = (img.shape[1],img.shape[0])
+    if size not in WARPS:
+        WARPS[size] = make_warp(size,SETTINGS) #from the cache after the first time
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    out = f"{SETTINGS['out_dir']}/{name}_warped.{SETTINGS['ext']}"
+    cv.imwrite(out,WARPS[size].apply(img))
+    return f"saved {out}"
+
+##############################################################################################################
+
+def read_list(fname,placeholders=False):
+    ### paths of the images in an images.list file, paths that don't exist are looked for next to the list (e.g., if the night directory was moved)
+    paths = []
+    with open(fname) as f:
+        for line in f:
+            path = line.strip()
+            if path == "" or ((placeholders == False) & os.path.basename(path).startswith("PH-")):
+                continue
+            if not os.path.exists(path):
+                path = os.path.join(os.path.dirname(fname),os.path.basename(path))
+            paths.append(path)
+    return paths
+
+##############################################################################################################
+
+if __name__ == "__main__":
+    #command line arguments
+    parser = argparse.ArgumentParser(description = """
+    Applies the geometric correction (undistortion and/or homography) to all-sky images, or a whole night of them, using cached warp maps.
+    Author: George Hume
+    2022
+    """)
+    #adding arguments to praser object
+    parser.add_argument('paths' , type = str, nargs = '*', help = 'Path(s) to the all-sky image file(s).')
+    parser.add_argument('--list' , type = str, help = "Path to a night's images.list, to warp every image in it.", default = None)
+    parser.add_argument('--placeholders' , action = 'store_true', help = 'Also warp the placeholders in the images.list (skipped by default).')
+    parser.add_argument('--calibration' , type = str, help = 'Path to the camera parameter NPZ file from cam_calib.py, to undistort the images.', default = None)
+    parser.add_argument('--homography' , type = str, help = 'Path to the transformation matrix (transfrom-mat.npy) from geo-correct.py.', default = None)
+    parser.add_argument('--size' , type = int, nargs = 2, help = 'Width and height of the output of the homography.', default = [6000,6000])
+    parser.add_argument('--cache' , type = str, help = 'Directory the warp maps are saved in.', default = "warp-cache")
+    parser.add_argument('--workers' , type = int, help = 'Number of processes used (one per core by default, 1 to not use a pool).', default = os.cpu_count())
+    parser.add_argument('--out_dir' , type = str, help = "Path to directory files will be saved to. If doesn't exist it will be created.", default = "warp_out")
+    parser.add_argument('--ext' , type = str, help = 'Image file type the outputs will be saved as. Supports PNG (default), JPEG and BMP.', default = "png")
+    args = parser.parse_args()
+
+    if (args.calibration == None) & (args.homography == None):
+        print("ERROR: give a calibration and/or a homography to apply")
+        exit()
+
+    paths = list(args.paths)
+    if args.list != None:
+        paths += read_list(args.list,args.placeholders)
+    if len(paths) == 0:
+        print("ERROR: no images given")
+        exit()
+
+    os.makedirs(args.out_dir,exist_ok=True)
+    settings = {"calibration":args.calibration,"homography":args.homography,"size":args.size,"cache":args.cache,"out_dir":args.out_dir,"ext":args.ext}
+
+    #makes the maps for the first image before starting the pool, so the processes don't all make them at once
+    st = time.time()
+    first = cv.imread(paths[0],cv.IMREAD_UNCHANGED)
+    if first is not None:
+        make_warp((first.shape[1],first.shape[0]),settings)
+        print(f"warp maps ready in {time.time()-st:.2f} s")
+    del first
+
+    st = time.time()
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers,initializer=init,initargs=(settings,1)) as pool:
+            for line in pool.map(work,paths,chunksize=4): #images are read in the workers, only the paths are sent
+                print(line)
+    else:
+        init(settings)
+        for path in paths:
+            print(work(path))
+    print(f"{len(paths)} images done in {time.time()-st:.1f} s")